@@ -3,7 +3,7 @@ from os import path
 from flask import Flask
 from flask_bootstrap import Bootstrap
 from config import config
-from app import db
+from app import db, fragments, metrics, notify
 
 bootstrap = Bootstrap()
 
@@ -13,13 +13,23 @@ def create_app(config_name: str) -> Flask:
     app.config['UPLOAD_PATH'] = path.join(app.root_path, 'static')
     
     db.init_app(app)
+    metrics.init_app(app)
+    notify.init_app(app)
+    fragments.init_app(app)
     bootstrap.init_app(app)
 
+    from app.models import User
+    User.cache.maxsize = app.config['USER_CACHE_SIZE']
+
     from .main import main
     app.register_blueprint(main)
     from .auth import auth
     app.register_blueprint(auth, url_prefix='/auth')
     from .admin import admin
     app.register_blueprint(admin, url_prefix='/admin')
+    from app import bulk, images, stock
+    bulk.init_app(app)
+    images.init_app(app)
+    stock.init_app(app)
 
     return app
\ No newline at end of file
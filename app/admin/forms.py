@@ -1,8 +1,10 @@
 import os
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileAllowed, FileRequired
 from wtforms import MultipleFileField, StringField, SelectField, TextAreaField \
-    ,FloatField, DecimalField, SubmitField, IntegerField, ValidationError
-from wtforms.validators import DataRequired, Length
+    ,FloatField, DecimalField, SubmitField, IntegerField, BooleanField, ValidationError
+from wtforms.validators import DataRequired, Length, Optional
+from wtforms.widgets import HiddenInput
 from app.models import Product
 
 
@@ -21,6 +23,8 @@ class ProductForm(FlaskForm):
     discount = FloatField('Discount', default=0.0)
     units_in_stock = IntegerField('Units in stock')
     description = TextAreaField('Description')
+    # filled in with the product on update, see Product.update_product
+    version = IntegerField(widget=HiddenInput(), validators=[Optional()])
     images = MultipleFileField('Add images')
     save = SubmitField('Save')
     save_and_continue = SubmitField('Save and add another')
@@ -33,17 +37,36 @@ class ProductForm(FlaskForm):
         if field.data < 0:
             raise ValidationError('Price has to be positive.')
     
+# submitted with GET, so the filter lives in the URL; it only changes what
+# is shown and needs no CSRF token
 class ProductFilterForm(FlaskForm):
-    filter_mode = SelectField(
+    class Meta:
+        csrf = False
+
+    mode = SelectField(
         'Filter by', choices= (
-            (1, 'Name'),
-            (2, 'Category')
-        ), validators=[DataRequired()]
+            ('search', 'Search'),
+            ('name', 'Name or SKU'),
+            ('category', 'Category name')
+        )
+    )
+    q = StringField('Query')
+    category_id = SelectField('Category')
+    supplier_id = SelectField('Supplier')
+    price_min = StringField('Price from')
+    price_max = StringField('Price to')
+    in_stock = BooleanField('In stock')
+    sort = SelectField(
+        'Sort by', choices= (
+            ('', 'Default'),
+            ('-id', 'Newest'),
+            ('name', 'Name'),
+            ('price', 'Price, low to high'),
+            ('-price', 'Price, high to low')
+        )
     )
-    query = StringField('Query')
-    reset = SubmitField('Reset')
-    search = SubmitField('Search')
 
-    def validate_query(self, field):
-        if field and len(field.data) < 1 and self.search.data:
-            raise ValidationError('Query has to include at leats one symbol.')
+class ProductImportForm(FlaskForm):
+    csv_file = FileField('CSV file', validators=[FileRequired(), FileAllowed(['csv'], 'CSV files only.')])
+    strict = BooleanField('Reject the whole file if any row is invalid')
+    submit = SubmitField('Import')
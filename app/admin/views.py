@@ -1,11 +1,22 @@
-import os
+import math
+from decimal import Decimal, InvalidOperation
+from urllib.parse import parse_qsl
 
-from flask import redirect, render_template, request, url_for, current_app, jsonify, send_from_directory
+from flask import flash, g, redirect, render_template, request, url_for, current_app, jsonify, abort
 from flask_paginate import Pagination
+from werkzeug.datastructures import MultiDict
 from app.admin import admin
-from app.admin.forms import ProductForm, ProductFilterForm
-from app.decorators import admin_required
-from app.models import User, Supplier, Category, Product
+from app.admin.forms import ProductForm, ProductFilterForm, ProductImportForm
+from app.bulk import import_products, IMPORT_COLUMNS, product_target, delete_products, \
+    change_prices, set_discount, adjust_stock, adjust_stock_each
+from app.db import get_pool, get_read_pools
+from app.decorators import admin_required, catalog_conditional
+from app.fragments import cached_fragment
+from app.metrics import metrics
+from app.models import User, Supplier, Category, Product, ProductFilter, Property, Sales, \
+    StaleProduct
+from app.serializers import dumps
+from app.streaming import stream_rows
 
 
 @admin.route('/', methods=['GET', 'POST'])
@@ -13,45 +24,95 @@ from app.models import User, Supplier, Category, Product
 def panel():
     return render_template('admin/panel.html')
 
+@admin.route('/pool', methods=['GET'])
+@admin_required
+def pool_stats():
+    stats = get_pool().stats()
+    stats['replicas'] = [pool.stats() for pool in get_read_pools()]
+    return jsonify(stats)
+
+@admin.route('/metrics', methods=['GET'])
+@admin_required
+def metrics_export():
+    return current_app.response_class(
+        metrics.render(get_pool().stats()), mimetype='text/plain; version=0.0.4'
+    )
+
+@admin.route('/metrics/slow-queries', methods=['GET'])
+@admin_required
+def slow_queries():
+    return jsonify(slow_queries=list(metrics.slow_queries))
+
+@admin.route('/reports', methods=['GET'])
+@admin_required
+def reports():
+    limit = min(request.args.get('limit', type=int, default=20), 500)
+    return render_template('admin/reports.html',
+        customers=Sales.top_customers(limit),
+        categories=Sales.by_category(),
+        suppliers=Sales.by_supplier()
+    )
+
 @admin.route('/users', methods=['GET'])
 @admin_required
 def users():
-    q = request.args.get('q')
-    search = q is not None
+    q = request.args.get('q', '').strip()
+    search = bool(q)
+    exact = request.args.get('exact') == '1'
     page = request.args.get('page', type=int, default=1)
-    total, users = User.get_paginated_users(page=page)
-    pagination = Pagination(page=page, total=total, search=search, css_framework='foundation', 
-        per_page=User.per_page)
-    return render_template('admin/users.html', users=users, pagination=pagination)
 
-@admin.route('/products', methods=['GET', 'POST'])
-@admin_required
-def product_list():
-    form = ProductFilterForm()
+    version = User.get_version()
 
-    if form.validate_on_submit():
-        if form.reset.data: return redirect(url_for('admin.product_list'))
+    def render_table():
+        total, users = User.get_paginated_users(page=page, query=q, exact=exact,
+            version=version)
+        pagination = Pagination(page=page, total=total, search=search, found=total,
+            css_framework='foundation', per_page=User.per_page)
+        return render_template('admin/_user_table.html', users=users, pagination=pagination)
 
-        elif form.search.data or form.query.data:
+    key = ('admin.users', q, exact, page, User.per_page, version)
+    return render_template('admin/users.html', table=cached_fragment(key, render_table), q=q)
 
-            data = {'value': form.filter_mode.data, 'query': form.query.data}
-            pagination, products = Product.get_paginated_by(data, request.args)
-            return render_template('admin/product_list.html', form=form,
-                products=products, pagination=pagination
-            )
+@admin.route('/users/export.<any(ndjson, csv):fmt>', methods=['GET'])
+@admin_required
+def users_export(fmt):
+    return stream_rows(User.stream_all(), fmt, 'users')
 
-    elif request.args.get('page'):
-        data = {'value': Product.last_option, 'query': Product.last_query}
-        pagination, products = Product.get_paginated_by(data, request.args)
-        return render_template('admin/product_list.html', form=form,
-                products=products, pagination=pagination
+@admin.route('/products', methods=['GET'])
+@admin_required
+@catalog_conditional
+def product_list():
+    product_filter = ProductFilter.from_args(request.args)
+    canonical = product_filter.to_args()
+    if list(request.args.items(multi=True)) != [(k, str(v)) for k, v in canonical.items()]:
+        return redirect(url_for('admin.product_list', **canonical), code=301)
+
+    def render_table():
+        pagination, products, facets = Product.get_paginated(product_filter)
+        properties = Property.get_for_products([product.product_id for product in products])
+        return render_template('admin/_product_table.html',
+            products=products, pagination=pagination, properties=properties,
+            facets=facets, product_filter=product_filter
         )
 
-    pagination, products = Product.get_paginated_by({'value': 0}, request.args)
-    return render_template('admin/product_list.html', form=form, 
-        products=products, pagination=pagination
+    # the rows, facets and links only change with the filter, the catalog and
+    # the stock; g.catalog_version holds both versions
+    key = ('admin.product_list', tuple(canonical.items()),
+        current_app.config['PRODUCTS_PER_PAGE'], g.catalog_version)
+    form = ProductFilterForm(request.args)
+    form.category_id.choices = [('', 'Any')] + \
+        [(str(pk), name) for pk, name in Category.get_all_choices()]
+    form.supplier_id.choices = [('', 'Any')] + \
+        [(str(pk), name) for pk, name in Supplier.get_all_choices()]
+    return render_template('admin/product_list.html', form=form,
+        table=cached_fragment(key, render_table)
     )
 
+@admin.route('/products/export.<any(ndjson, csv):fmt>', methods=['GET'])
+@admin_required
+def products_export(fmt):
+    return stream_rows(Product.stream_all(), fmt, 'products')
+
 @admin.route('/products/add', methods=['GET', 'POST'])
 @admin_required
 def product_add():
@@ -76,6 +137,19 @@ def product_add():
     
     return render_template('admin/product_add.html', form=form)
 
+@admin.route('/products/import', methods=['GET', 'POST'])
+@admin_required
+def product_import():
+    form = ProductImportForm()
+    report = None
+
+    if form.validate_on_submit():
+        report = import_products(form.csv_file.data.stream, strict=form.strict.data)
+
+    return render_template('admin/product_import.html', form=form, report=report,
+        columns=IMPORT_COLUMNS
+    )
+
 @admin.route('/products/update/<int:pk>', methods=['GET', 'POST'])
 @admin_required
 def product_update(pk):
@@ -84,17 +158,23 @@ def product_update(pk):
     form.supplier_id.choices = Supplier.get_all_choices()
 
     if form.validate_on_submit():
-        Product.update_product(
-            pk,
-            form.supplier_id.data,
-            form.category_id.data,
-            form.product_name.data,
-            form.sku.data,
-            form.unit_price.data,
-            form.discount.data,
-            form.units_in_stock.data,
-            form.description.data
-        )
+        try:
+            Product.update_product(
+                pk,
+                form.supplier_id.data,
+                form.category_id.data,
+                form.product_name.data,
+                form.sku.data,
+                form.unit_price.data,
+                form.discount.data,
+                form.units_in_stock.data,
+                form.description.data,
+                form.version.data
+            )
+        except StaleProduct:
+            # the page reloads the current product into the form
+            return render_template('admin/product_update.html', form=form, pk=pk,
+                stale=True), 409
         Product.save_images(request.files.getlist('images'), form.sku.data)
         if form.save.data: return redirect(url_for('admin.panel'))
         else: return redirect(url_for('admin.product_update', pk=pk))
@@ -104,19 +184,121 @@ def product_update(pk):
 @admin.route('/products/<int:pk>', methods=['DELETE'])
 @admin_required
 def product_delete(pk):
-    Product.delete(pk)
+    if not Product.delete(pk):
+        flash(f'Product {pk} was not deleted: it is ordered or reserved.')
+        return {'success': False}, 409
     return {'success': True}
 
+# JSON body: the products as "ids" or as "filter", the query string of the
+# product list, plus the value of the action; answers with counts and timing
+@admin.route('/products/bulk/<any(delete, price, discount, stock):action>', methods=['POST'])
+@admin_required
+def product_bulk(action):
+    data = request.get_json()
+    if not isinstance(data, dict): abort(400, 'Expected a JSON object.')
+
+    if action == 'stock' and data.get('deltas') is not None:
+        deltas = parse_deltas(data['deltas'])
+        return jsonify(adjust_stock_each(deltas))
+
+    target = bulk_target(data)
+    if action == 'delete':
+        report = delete_products(target)
+    elif action == 'price':
+        percent = parse_number(data.get('percent'), Decimal)
+        if percent is None or not -100 < percent <= 1000:
+            abort(400, 'percent has to be a number above -100 and up to 1000.')
+        report = change_prices(target, percent)
+    elif action == 'discount':
+        discount = parse_number(data.get('discount'), float)
+        if discount is None or not 0 <= discount <= 1:
+            abort(400, 'discount has to be from 0 to 1.')
+        report = set_discount(target, discount)
+    else:
+        delta = data.get('delta')
+        if not isinstance(delta, int) or isinstance(delta, bool):
+            abort(400, 'delta has to be an integer.')
+        report = adjust_stock(target, delta)
+    return jsonify(report)
+
+def bulk_target(data: dict):
+    ids = data.get('ids')
+    if ids is not None:
+        if not isinstance(ids, list) or not ids or len(ids) > 10000 \
+                or not all(type(pk) is int for pk in ids):
+            abort(400, 'ids has to be a list of 1 to 10000 product ids.')
+        return product_target(pks=list(dict.fromkeys(ids)))
+
+    product_filter = ProductFilter.from_args(MultiDict(parse_qsl(data.get('filter') or '')))
+    if not product_filter.conditions()[0] and not product_filter.mode:
+        abort(400, 'Pass ids or a filter that narrows the product list.')
+    return product_target(product_filter=product_filter,
+        search_limit=current_app.config['SEARCH_LIMIT'])
+
+def parse_number(value, number_type):
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)): return None
+    try:
+        number = number_type(str(value))
+        finite = math.isfinite(number)
+    except (ValueError, InvalidOperation):
+        return None
+    return number if finite else None
+
+def parse_deltas(value) -> dict:
+    try:
+        deltas = {int(pk): delta for pk, delta in value.items()}
+    except (AttributeError, ValueError):
+        deltas = None
+    if not deltas or len(deltas) > 10000 \
+            or not all(type(delta) is int for delta in deltas.values()):
+        abort(400, 'deltas has to map 1 to 10000 product ids to integer changes.')
+    return deltas
+
 @admin.route('/products/<int:pk>', methods=['GET'])
 @admin_required
+@catalog_conditional
 def product_get(pk):
     response = Product.get_json(pk)
-    return response
+    if response is None: abort(404)
+    return current_app.response_class(response, mimetype='application/json')
+
+@admin.route('/products/batch', methods=['GET'])
+@admin_required
+@catalog_conditional
+def product_batch():
+    pks = parse_ids(request.args.get('ids'))
+    products = Product.get_many(pks)
+    data = {'products': [products[pk]._asdict() for pk in pks if pk in products]}
+    return current_app.response_class(dumps(data), mimetype='application/json')
+
+def parse_ids(value: str, limit: int = 500) -> list:
+    ids = [int(pk) for pk in (value or '').split(',') if pk.strip().isdigit()]
+    if not ids or len(ids) > limit:
+        abort(400, f'Pass from 1 to {limit} comma-separated ids.')
+    return list(dict.fromkeys(ids))
+
+def image_manifest(images: list) -> list:
+    return [{
+        'url': url_for('static', filename=image['image_path']),
+        'width': image['width'],
+        'height': image['height'],
+        'thumb_url': url_for('static', filename=image['thumb_path']),
+        'thumb_width': image['thumb_width'],
+        'thumb_height': image['thumb_height'],
+    } for image in images]
 
 @admin.route('/products/<int:pk>/images', methods=['GET'])
+@admin_required
+@catalog_conditional(stock=False)
 def product_images(pk):
-    img_dir = '/'.join(['products', str(pk)])
-    img_path = os.path.join(current_app.config['UPLOAD_PATH'], img_dir)
-    img_names = os.listdir(img_path) if os.path.exists(img_path) else []
-    images = [url_for('static', filename=os.path.join(img_dir, img)) for img in img_names]
-    return jsonify(images=images)
+    images = Product.get_image_manifests([pk])[pk]
+    data = {'images': image_manifest(images)}
+    return current_app.response_class(dumps(data), mimetype='application/json')
+
+@admin.route('/products/images', methods=['GET'])
+@admin_required
+@catalog_conditional(stock=False)
+def product_images_batch():
+    manifests = Product.get_image_manifests(parse_ids(request.args.get('ids')))
+    data = {str(pk): image_manifest(images) for pk, images in manifests.items()}
+    return current_app.response_class(dumps({'manifests': data}), mimetype='application/json')
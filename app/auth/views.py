@@ -45,4 +45,4 @@ def load_logged_in_user():
     user_email = session.get('user_email')
     if user_email is None:
         g.current_user = None
-    else: g.current_user = User.get_by_email(user_email)
+    else: g.current_user = User.get_cached(user_email)
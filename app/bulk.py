@@ -0,0 +1,297 @@
+import csv
+import time
+import click
+import psycopg2
+from decimal import Decimal
+from typing import List, Tuple
+from flask.cli import with_appcontext
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+from app.db import get_read_db, transaction
+from app.images import remove_image_dirs
+from app.models import Product, ProductFilter
+
+IMPORT_COLUMNS = (
+    'sku', 'product_name', 'category_id', 'supplier_id',
+    'unit_price', 'discount', 'units_in_stock', 'description'
+)
+MAX_REPORTED_ERRORS = 1000
+
+CREATE_STAGING = f"""
+    CREATE TEMP TABLE products_staging (
+        line_no serial,
+        {', '.join(f'{column} text' for column in IMPORT_COLUMNS)},
+        error text
+    ) ON COMMIT DROP
+"""
+
+COPY_IN = f"""
+    COPY products_staging ({', '.join(IMPORT_COLUMNS)})
+    FROM STDIN WITH (FORMAT csv)
+"""
+
+VALIDATE = r"""
+    UPDATE products_staging s SET error = CASE
+        WHEN nullif(trim(sku), '') IS NULL THEN 'sku is required'
+        WHEN length(trim(sku)) > 20 THEN 'sku is longer than 20 characters'
+        WHEN nullif(trim(product_name), '') IS NULL THEN 'product_name is required'
+        WHEN length(trim(product_name)) > 60 THEN 'product_name is longer than 60 characters'
+        WHEN category_id !~ '^\s*\d{1,9}\s*$' THEN 'category_id is not an integer'
+        WHEN NOT EXISTS (
+            SELECT 1 FROM categories c WHERE c.category_id = s.category_id::int
+        ) THEN 'unknown category_id'
+        WHEN supplier_id !~ '^\s*\d{1,9}\s*$' THEN 'supplier_id is not an integer'
+        WHEN NOT EXISTS (
+            SELECT 1 FROM suppliers su WHERE su.supplier_id = s.supplier_id::int
+        ) THEN 'unknown supplier_id'
+        WHEN nullif(trim(unit_price), '') IS NULL THEN 'unit_price is required'
+        WHEN unit_price !~ '^\s*(\d{1,9}(\.\d*)?|\.\d+)\s*$' THEN 'unit_price is not a positive number'
+        WHEN coalesce(discount, '') !~ '^\s*((0|1)(\.\d*)?|\.\d+)?\s*$' THEN 'discount is not a number'
+        WHEN coalesce(nullif(trim(discount), '')::real, 0) > 1 THEN 'discount has to be from 0 to 1'
+        WHEN coalesce(units_in_stock, '') !~ '^\s*(-?\d{1,9})?\s*$' THEN 'units_in_stock is not an integer'
+        WHEN d.last_line <> s.line_no THEN concat('sku is repeated on line ', d.last_line + 1)
+    END
+    FROM (
+        SELECT line_no, max(line_no) OVER (PARTITION BY trim(sku)) AS last_line
+        FROM products_staging
+    ) d
+    WHERE d.line_no = s.line_no
+"""
+
+UPSERT = """
+    WITH upserted AS (
+        INSERT INTO products (
+            sku, product_name, category_id, supplier_id,
+            unit_price, discount, units_in_stock, description
+        )
+        SELECT trim(sku), trim(product_name),
+               category_id::int, supplier_id::int,
+               trim(unit_price)::numeric(15, 6),
+               coalesce(nullif(trim(discount), '')::real, 0),
+               coalesce(nullif(trim(units_in_stock), '')::int, 0),
+               nullif(description, '')
+        FROM products_staging
+        WHERE error IS NULL
+        ON CONFLICT (sku) DO UPDATE SET
+            product_name   = EXCLUDED.product_name,
+            category_id    = EXCLUDED.category_id,
+            supplier_id    = EXCLUDED.supplier_id,
+            unit_price     = EXCLUDED.unit_price,
+            discount       = EXCLUDED.discount,
+            units_in_stock = EXCLUDED.units_in_stock,
+            description    = EXCLUDED.description
+        RETURNING (xmax = 0) AS inserted
+    )
+    SELECT count(*) FILTER (WHERE inserted),
+           count(*) FILTER (WHERE NOT inserted)
+    FROM upserted
+"""
+
+ERRORS = """
+    SELECT line_no + 1, sku, error
+    FROM products_staging
+    WHERE error IS NOT NULL
+    ORDER BY line_no
+"""
+
+COPY_OUT = """
+    COPY (SELECT * FROM v_products_all ORDER BY product_id)
+    TO STDOUT WITH (FORMAT csv, HEADER true)
+"""
+
+def make_report(rows: int, started: float, **report) -> dict:
+    seconds = time.perf_counter() - started
+    report.update(
+        rows=rows, seconds=round(seconds, 3),
+        rows_per_sec=round(rows / seconds) if seconds else rows
+    )
+    return report
+
+# reads the header line, so COPY starts at the first row; columns are loaded
+# by position, a file with other or reordered columns is rejected
+def check_header(fileobj) -> str:
+    line = fileobj.readline()
+    if isinstance(line, bytes): line = line.decode('utf-8-sig', 'replace')
+    header = [column.strip().lower() for column in next(csv.reader([line]), [])]
+    if header != list(IMPORT_COLUMNS):
+        return f"the header has to be {','.join(IMPORT_COLUMNS)}, not {','.join(header) or 'empty'}"
+    return None
+
+# upserts products by sku from a CSV file with IMPORT_COLUMNS; invalid rows
+# are reported by file line and skipped, or abort the import when strict
+def import_products(fileobj, strict: bool = False) -> dict:
+    started = time.perf_counter()
+    error = check_header(fileobj)
+    if error:
+        return make_report(0, started, inserted=0, updated=0,
+            error_count=1, errors=[(1, None, error)])
+    try:
+        with transaction() as connection:
+            cursor = connection.cursor()
+            cursor.execute(CREATE_STAGING)
+            cursor.copy_expert(COPY_IN, fileobj)
+            rows = cursor.rowcount
+
+            cursor.execute(VALIDATE)
+            cursor.execute(ERRORS)
+            errors = cursor.fetchmany(MAX_REPORTED_ERRORS)
+            error_count = len(errors) + len(cursor.fetchall())
+            if strict and error_count:
+                connection.rollback()
+                return make_report(rows, started, inserted=0, updated=0,
+                    error_count=error_count, errors=errors)
+
+            cursor.execute(UPSERT)
+            inserted, updated = cursor.fetchone()
+    except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+        # malformed CSV (e.g. wrong number of columns), or a row the checks
+        # above let through, rejects the whole file
+        message = e.diag.message_primary or str(e)
+        if e.diag.context: message = f'{message} ({e.diag.context})'
+        return make_report(0, started, inserted=0, updated=0,
+            error_count=1, errors=[(None, None, message)])
+
+    Product.invalidate_pages()
+    Product.invalidate_rows()
+    return make_report(rows, started, inserted=inserted, updated=updated,
+        error_count=error_count, errors=errors)
+
+def export_products(fileobj) -> dict:
+    started = time.perf_counter()
+    with transaction(get_read_db()) as connection:
+        cursor = connection.cursor()
+        cursor.copy_expert(COPY_OUT, fileobj)
+        rows = cursor.rowcount
+    return make_report(rows, started)
+
+# bulk edits of the admin list: each runs as set-based statements in one
+# transaction over the products chosen by id or by a list filter
+
+def product_target(pks: List[int] = None, product_filter: ProductFilter = None,
+                   search_limit: int = None) -> Tuple[sql.Composable, list]:
+    if pks is not None:
+        return sql.SQL('p.product_id = ANY(%s)'), [list(pks)]
+    conditions, params = product_filter.conditions()
+    if product_filter.mode == 'search':
+        # the same matches the list shows, not every product
+        conditions.append(sql.SQL(
+            'p.product_id IN (SELECT product_id FROM search_products(%s, %s))'
+        ))
+        params.extend([product_filter.q, search_limit])
+    return sql.SQL(' AND ').join(conditions), params
+
+# rows are locked in product_id order first, the order reserve_stock locks
+# them in, so a bulk edit and a checkout queue instead of deadlocking
+def lock_products(cursor, condition: sql.Composable, params: list) -> List[int]:
+    cursor.execute(sql.SQL("""
+        SELECT p.product_id FROM products p
+        WHERE {}
+        ORDER BY p.product_id
+        FOR NO KEY UPDATE
+    """).format(condition).as_string(cursor.connection), params)
+    return [row[0] for row in cursor.fetchall()]
+
+def run_update(assignment: str, values: list, target: Tuple[sql.Composable, list]) -> List[int]:
+    condition, params = target
+    query = sql.SQL('UPDATE products p SET {} WHERE p.product_id = ANY(%s)').format(
+        sql.SQL(assignment)
+    )
+    with transaction() as connection:
+        cursor = connection.cursor()
+        pks = lock_products(cursor, condition, params)
+        cursor.execute(query.as_string(connection), values + [pks])
+        return pks
+
+def finish(pks: List[int], started: float, **report) -> dict:
+    Product.invalidate_pages()
+    Product.invalidate_rows(pks)
+    return make_report(len(pks), started, **report)
+
+def delete_products(target: Tuple[sql.Composable, list]) -> dict:
+    # products that were ever ordered stay, order history references them;
+    # so do products held by pending reservations
+    started = time.perf_counter()
+    condition, params = target
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute(sql.SQL("""
+            SELECT p.product_id,
+                   EXISTS (SELECT 1 FROM order_details d WHERE d.product_id = p.product_id)
+                   OR EXISTS (SELECT 1 FROM reservation_lines r WHERE r.product_id = p.product_id)
+            FROM products p
+            WHERE {}
+            ORDER BY p.product_id
+            FOR UPDATE
+        """).format(condition).as_string(connection), params)
+        rows = cursor.fetchall()
+        pks = [pk for pk, referenced in rows if not referenced]
+        cursor.execute('DELETE FROM product_properties WHERE product_id = ANY(%s)', (pks, ))
+        cursor.execute(
+            'DELETE FROM products WHERE product_id = ANY(%s) RETURNING pictures_directory',
+            (pks, )
+        )
+        img_dirs = [row[0] for row in cursor.fetchall()]
+
+    directories = remove_image_dirs(img_dirs)
+    return finish(pks, started, directories=directories, skipped=len(rows) - len(pks))
+
+def change_prices(target: Tuple[sql.Composable, list], percent: Decimal) -> dict:
+    started = time.perf_counter()
+    pks = run_update(
+        'unit_price = round(p.unit_price * (100 + %s) / 100, 2)', [percent], target
+    )
+    return finish(pks, started)
+
+def set_discount(target: Tuple[sql.Composable, list], discount: float) -> dict:
+    started = time.perf_counter()
+    pks = run_update('discount = %s', [discount], target)
+    return finish(pks, started)
+
+def adjust_stock(target: Tuple[sql.Composable, list], delta: int) -> dict:
+    started = time.perf_counter()
+    pks = run_update('units_in_stock = greatest(p.units_in_stock + %s, 0)', [delta], target)
+    return finish(pks, started)
+
+def adjust_stock_each(deltas: dict) -> dict:
+    # a different change per product, sent as one batched statement
+    started = time.perf_counter()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        lock_products(cursor, sql.SQL('p.product_id = ANY(%s)'), [list(deltas)])
+        pks = [row[0] for row in execute_values(cursor, """
+            UPDATE products p
+            SET units_in_stock = greatest(p.units_in_stock + v.delta, 0)
+            FROM (VALUES %s) AS v (product_id, delta)
+            WHERE p.product_id = v.product_id
+            RETURNING p.product_id
+        """, sorted(deltas.items()), template='(%s::int, %s::int)',
+            page_size=len(deltas), fetch=True)]
+    return finish(pks, started)
+
+@click.command('import-products')
+@click.argument('csv_file', type=click.File('rb'))
+@click.option('--strict', is_flag=True, help='Import nothing if any row is invalid.')
+@with_appcontext
+def import_products_command(csv_file, strict):
+    report = import_products(csv_file, strict=strict)
+    for line, sku, error in report['errors']:
+        click.echo(f'line {line} ({sku}): {error}' if line else error, err=True)
+    click.echo(
+        f"{report['rows']} rows read, {report['inserted']} inserted, "
+        f"{report['updated']} updated, {report['error_count']} rejected "
+        f"in {report['seconds']}s ({report['rows_per_sec']} rows/sec)"
+    )
+
+@click.command('export-products')
+@click.argument('csv_file', type=click.File('w', encoding='utf-8'), default='-')
+@with_appcontext
+def export_products_command(csv_file):
+    report = export_products(csv_file)
+    click.echo(
+        f"{report['rows']} rows exported in {report['seconds']}s "
+        f"({report['rows_per_sec']} rows/sec)", err=True
+    )
+
+def init_app(app):
+    app.cli.add_command(import_products_command)
+    app.cli.add_command(export_products_command)
@@ -0,0 +1,132 @@
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    def __init__(self, maxsize: int = 1024, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None: return default
+            value, expires_at = item
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return item[0] if item is not None else default
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, self) is not self
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+# fragment stores keep rendered HTML under a hex digest; callers put a data
+# version into the key, so entries never go stale, they only fall out of use
+
+# bounded by the total length of the stored HTML
+class MemoryFragmentStore:
+    def __init__(self, max_size: int = 32 * 1024 * 1024):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> str:
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None: self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        size = len(value)
+        if size > self.max_size: return
+        with self._lock:
+            previous = self._data.pop(key, None)
+            if previous is not None: self._size -= len(previous)
+            self._data[key] = value
+            self._size += size
+            while self._size > self.max_size:
+                _, evicted = self._data.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._size = 0
+
+# shared by all workers of a host; the oldest files are pruned once
+# more than max_files have been written
+class FileFragmentStore:
+    def __init__(self, path: str, max_files: int = 10000):
+        self.path = path
+        self.max_files = max_files
+        self._writes = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, f'{key}.html')
+
+    def get(self, key: str) -> str:
+        try:
+            with open(self._file(key), encoding='utf-8') as fhand:
+                return fhand.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key: str, value: str) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as fhand:
+            fhand.write(value)
+        os.replace(tmp_path, self._file(key))
+        self._writes += 1
+        if self._writes % 100 == 0: self.prune()
+
+    def prune(self) -> None:
+        entries = []
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if not entry.name.endswith('.html'): continue
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass
+        entries.sort()
+        for _, path in entries[:max(len(entries) - self.max_files, 0)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def clear(self) -> None:
+        for name in os.listdir(self.path):
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
@@ -1,20 +1,121 @@
 import psycopg2
 import click
 import os
-from flask import current_app, g
+import threading
+import time
+from contextlib import contextmanager
+from itertools import count
+from flask import current_app, g, has_request_context, session
 from flask.cli import with_appcontext
+from app.metrics import TimedCursor
+from app.pool import ConnectionPool, PoolTimeout
 
 
+_pool_lock = threading.Lock()
+_replica_turn = count()
+
+def create_pool(dsn: dict) -> ConnectionPool:
+    config = current_app.config
+    return ConnectionPool(
+        dsn,
+        min_size=config['DB_POOL_MIN_SIZE'],
+        max_size=config['DB_POOL_MAX_SIZE'],
+        timeout=config['DB_POOL_TIMEOUT'],
+        check=config['DB_POOL_CHECK'],
+        cursor_factory=TimedCursor,
+    )
+
+def get_pool() -> ConnectionPool:
+    pool = current_app.extensions.get('db_pool')
+    if pool is None or pool.pid != os.getpid():
+        with _pool_lock:
+            pool = current_app.extensions.get('db_pool')
+            if pool is None or pool.pid != os.getpid():
+                pool = create_pool(current_app.config['DATABASE'])
+                current_app.extensions['db_pool'] = pool
+    return pool
+
+def get_read_pools() -> list:
+    pools = current_app.extensions.get('db_read_pools')
+    if pools is None or any(pool.pid != os.getpid() for pool in pools):
+        with _pool_lock:
+            pools = current_app.extensions.get('db_read_pools')
+            if pools is None or any(pool.pid != os.getpid() for pool in pools):
+                pools = [create_pool(dsn) for dsn in current_app.config['READ_DATABASES']]
+                current_app.extensions['db_read_pools'] = pools
+    return pools
+
 def get_db():
     if 'db' not in g:
-        g.db = psycopg2.connect(**current_app.config['DATABASE'])
-        g.db.autocommit = True
+        g.db = get_pool().getconn()
     return g.db
 
+def mark_write() -> None:
+    # reads of this request and, for READ_AFTER_WRITE seconds, of this
+    # session go to the primary, so nobody misses their own change
+    g.db_written = True
+    if has_request_context() and current_app.config['READ_DATABASES']:
+        session['db_written_at'] = time.time()
+
+def reads_from_primary() -> bool:
+    if g.get('db_written'): return True
+    # a transaction in progress must see its own uncommitted rows
+    if 'db' in g and not g.db.autocommit: return True
+    if not has_request_context(): return False
+    written_at = session.get('db_written_at')
+    return written_at is not None and \
+        time.time() - written_at < current_app.config['READ_AFTER_WRITE']
+
+def get_read_db():
+    pools = get_read_pools()
+    if not pools or reads_from_primary():
+        return get_db()
+    if 'read_db' in g: return g.read_db[1]
+
+    # round robin over the replicas, skipping ones that cannot be reached
+    start = next(_replica_turn)
+    for i in range(len(pools)):
+        pool = pools[(start + i) % len(pools)]
+        try:
+            g.read_db = (pool, pool.getconn())
+            return g.read_db[1]
+        except (psycopg2.OperationalError, PoolTimeout) as e:
+            current_app.logger.warning('Read replica unavailable: %s', e)
+    return get_db()
+
 def close_db(e=None):
     db = g.pop('db', None)
     if db is not None:
-        db.close()
+        get_pool().putconn(db)
+    read_db = g.pop('read_db', None)
+    if read_db is not None:
+        pool, connection = read_db
+        pool.putconn(connection)
+
+# without a connection runs on the primary and counts as a write once committed
+@contextmanager
+def transaction(connection=None):
+    primary = connection is None
+    connection = connection or get_db()
+    if not connection.autocommit:
+        # already inside a transaction, let the outermost block finish it
+        yield connection
+        return
+    connection.autocommit = False
+    try:
+        yield connection
+        connection.commit()
+        if primary: mark_write()
+    except BaseException:
+        # also covers generators closed early by their consumer
+        connection.rollback()
+        raise
+    finally:
+        connection.autocommit = True
+
+def pool_unavailable(e):
+    current_app.logger.warning('Database pool exhausted: %s', e)
+    return 'Service temporarily unavailable', 503
 
 def init_db():
     with current_app.open_resource('schema.sql', 'r') as fhand:
@@ -22,15 +123,45 @@ def init_db():
         connection.autocommit = True
         connection.cursor().execute(fhand.read())
         img_dir = os.path.join(current_app.root_path, current_app.config['UPLOAD_FOLDER'], 'products')
-        if not os.path.exists(img_dir): 
+        if not os.path.exists(img_dir):
             os.mkdir(img_dir)
 
+def refresh_ref_data():
+    connection = psycopg2.connect(**current_app.config['DATABASE'])
+    connection.autocommit = True
+    connection.cursor().execute(
+        'UPDATE ref_versions SET version = version + 1, updated_at = now()'
+    )
+    connection.cursor().execute("SELECT pg_notify('ref_data_changed', '')")
+    connection.close()
+
+def rebuild_aggregates():
+    connection = psycopg2.connect(**current_app.config['DATABASE'])
+    with connection:
+        connection.cursor().execute('CALL rebuild_sales_aggregates()')
+    connection.close()
+
 def init_app(app):
     app.teardown_appcontext(close_db)
+    app.register_error_handler(PoolTimeout, pool_unavailable)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(refresh_ref_data_command)
+    app.cli.add_command(rebuild_aggregates_command)
 
 @click.command('init-db')
 @with_appcontext
 def init_db_command():
     init_db()
     click.echo('Initialized the database.')
+
+@click.command('refresh-refdata')
+@with_appcontext
+def refresh_ref_data_command():
+    refresh_ref_data()
+    click.echo('Reference data caches will be reloaded.')
+
+@click.command('rebuild-aggregates')
+@with_appcontext
+def rebuild_aggregates_command():
+    rebuild_aggregates()
+    click.echo('Rebuilt order totals, customer spend and sales aggregates.')
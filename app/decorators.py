@@ -1,5 +1,8 @@
 import functools
-from flask import g, redirect, url_for
+import hashlib
+from flask import current_app, g, make_response, redirect, request, session, url_for
+from werkzeug.http import is_resource_modified
+from app.models import Catalog
 
 
 def login_required(view):
@@ -13,7 +16,42 @@ def login_required(view):
 def admin_required(view):
     @functools.wraps(view)
     def wrapped_view(**kwargs):
-        if not g.current_user or not g.current_user['is_admin']:
+        if not g.current_user or not g.current_user.is_admin:
             return redirect(url_for('main.index'))
         return view(**kwargs)
     return wrapped_view
+
+# validates GET requests against the catalog version: an unchanged catalog is
+# answered with 304 before the view runs. The user is part of the ETag because
+# pages differ per login, and the URL is the cache key anyway. Views showing
+# no stock pass stock=False and are not revalidated by every checkout.
+def catalog_conditional(view=None, stock: bool = True):
+    if view is None: return functools.partial(catalog_conditional, stock=stock)
+
+    @functools.wraps(view)
+    def wrapped_view(**kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return view(**kwargs)
+
+        version, updated_at = Catalog.get_version(stock)
+        g.catalog_version = version
+        user = g.current_user.email if g.current_user else ''
+        etag = hashlib.sha1(f'{version}:{user}'.encode()).hexdigest()
+
+        # pending flash messages are shown once, so that page is never cached
+        flashed = '_flashes' in session
+        if not flashed and not is_resource_modified(
+                request.environ, etag=etag, last_modified=updated_at):
+            response = current_app.response_class(status=304)
+        else:
+            response = make_response(view(**kwargs))
+            if response.status_code != 200 or flashed: return response
+        response.set_etag(etag)
+        if updated_at is not None: response.last_modified = updated_at
+        # anonymous storefront pages may be kept by a shared cache too
+        if g.current_user: response.cache_control.private = True
+        else: response.cache_control.public = True
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+        return response
+    return wrapped_view
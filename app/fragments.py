@@ -0,0 +1,33 @@
+import hashlib
+import os
+from flask import current_app
+from markupsafe import Markup
+from app.cache import FileFragmentStore, MemoryFragmentStore
+
+def create_store(app):
+    backend = app.config['FRAGMENT_CACHE']
+    if backend == 'memory':
+        return MemoryFragmentStore(app.config['FRAGMENT_CACHE_SIZE'])
+    if backend == 'filesystem':
+        path = app.config['FRAGMENT_CACHE_PATH'] or os.path.join(app.instance_path, 'fragments')
+        return FileFragmentStore(path, app.config['FRAGMENT_CACHE_FILES'])
+    if backend in (None, '', 'none'):
+        return None
+    raise ValueError(f'Unknown FRAGMENT_CACHE backend: {backend}')
+
+# returns the HTML render() produced for key, rendering it only on a miss;
+# the key has to contain everything the fragment depends on, including
+# the version of the data it shows
+def cached_fragment(key: tuple, render) -> Markup:
+    store = current_app.extensions.get('fragment_cache')
+    if store is None: return Markup(render())
+
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()
+    html = store.get(digest)
+    if html is None:
+        html = render()
+        store.set(digest, html)
+    return Markup(html)
+
+def init_app(app):
+    app.extensions['fragment_cache'] = create_store(app)
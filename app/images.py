@@ -0,0 +1,258 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+import click
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from flask.cli import with_appcontext
+from PIL import Image, ImageOps
+
+# content-addressed store under UPLOAD_PATH: images/<hash[:2]>/<hash>{_web,_thumb}.jpg
+STORE_FOLDER = 'images'
+VARIANTS = ('web', 'thumb')
+
+_pipeline_lock = threading.Lock()
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fhand:
+        for chunk in iter(lambda: fhand.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def variant_name(digest: str, variant: str) -> str:
+    return '/'.join([STORE_FOLDER, digest[:2], f'{digest}_{variant}.jpg'])
+
+class ImagePipeline:
+    def __init__(self, app):
+        self.app = app
+        self.pid = os.getpid()
+        config = app.config
+        self.upload_path = config['UPLOAD_PATH']
+        self.spool_path = config['IMAGE_SPOOL_PATH'] or os.path.join(app.instance_path, 'spool')
+        self.sizes = {
+            'web': (config['IMAGE_WEB_SIZE'], ) * 2,
+            'thumb': (config['IMAGE_THUMB_SIZE'], ) * 2,
+        }
+        self.quality = config['IMAGE_WEB_QUALITY']
+        self.queue_timeout = config['IMAGE_QUEUE_TIMEOUT']
+        os.makedirs(self.spool_path, exist_ok=True)
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=config['IMAGE_WORKERS'], thread_name_prefix='images'
+        )
+        self.slots = threading.BoundedSemaphore(config['IMAGE_QUEUE_SIZE'])
+        # the newest upload of a product wins over jobs still in flight
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def spool(self, images) -> list:
+        spooled = []
+        for image in images:
+            fd, path = tempfile.mkstemp(dir=self.spool_path)
+            with os.fdopen(fd, 'wb') as fhand:
+                image.save(fhand)
+            spooled.append(path)
+        return spooled
+
+    def submit(self, pk: int, img_dir: str, spooled: list, on_publish=None) -> None:
+        with self.lock:
+            generation = self.generations.get(pk, 0) + 1
+            self.generations[pk] = generation
+
+        args = (pk, img_dir, spooled, generation, on_publish)
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            # queue is full: apply backpressure by doing the work in the
+            # request, on its app context and its database connection
+            current_app.logger.warning('Image queue is full, processing product %s inline', pk)
+            self.run(*args)
+            return
+        future = self.executor.submit(self.process, *args)
+        future.add_done_callback(lambda _: self.slots.release())
+
+    def process(self, pk: int, img_dir: str, spooled: list, generation: int,
+                on_publish=None) -> None:
+        with self.app.app_context():
+            self.run(pk, img_dir, spooled, generation, on_publish)
+
+    def run(self, pk: int, img_dir: str, spooled: list, generation: int,
+            on_publish=None) -> None:
+        try:
+            images = []
+            for path in spooled:
+                try:
+                    images.append(self.store(path))
+                except (OSError, Image.DecompressionBombError):
+                    current_app.logger.exception('Skipping unreadable image for product %s', pk)
+            if not self.is_current(pk, generation): return
+            self.publish(pk, img_dir, [image['hash'] for image in images], generation,
+                None if on_publish is None else
+                lambda: on_publish(pk, images, lambda: self.is_current(pk, generation)))
+        except Exception:
+            current_app.logger.exception('Image processing for product %s failed', pk)
+        finally:
+            for path in spooled:
+                if os.path.exists(path): os.remove(path)
+
+    def is_current(self, pk: int, generation: int) -> bool:
+        with self.lock:
+            return self.generations.get(pk) == generation
+
+    def store(self, path: str) -> dict:
+        digest = file_digest(path)
+        names = {variant: variant_name(digest, variant) for variant in VARIANTS}
+        targets = {
+            variant: os.path.join(self.upload_path, name) for variant, name in names.items()
+        }
+        sizes = {}
+        os.makedirs(os.path.dirname(targets['web']), exist_ok=True)
+
+        for variant, target in targets.items():
+            if os.path.exists(target):
+                with Image.open(target) as stored:
+                    sizes[variant] = stored.size
+
+        if len(sizes) < len(VARIANTS):
+            with Image.open(path) as image:
+                image = ImageOps.exif_transpose(image)
+                if image.mode != 'RGB':
+                    # flatten transparency onto white, JPEG has no alpha channel
+                    image = image.convert('RGBA')
+                    background = Image.new('RGB', image.size, 'white')
+                    background.paste(image, mask=image.getchannel('A'))
+                    image = background
+                for variant, target in targets.items():
+                    if variant in sizes: continue
+                    resized = image.copy()
+                    resized.thumbnail(self.sizes[variant], Image.LANCZOS)
+                    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.tmp')
+                    with os.fdopen(fd, 'wb') as fhand:
+                        resized.save(fhand, 'JPEG', quality=self.quality, optimize=True, progressive=True)
+                    os.replace(tmp_path, target)
+                    sizes[variant] = resized.size
+
+        return {
+            'hash': digest,
+            'image_path': names['web'],
+            'width': sizes['web'][0],
+            'height': sizes['web'][1],
+            'thumb_path': names['thumb'],
+            'thumb_width': sizes['thumb'][0],
+            'thumb_height': sizes['thumb'][1],
+        }
+
+    def publish(self, pk: int, img_dir: str, digests: list, generation: int,
+                on_publish=None) -> bool:
+        # products/<pk> is a symlink to an immutable image set, so readers
+        # see either the old or the new set, never a half-written one
+        final = os.path.join(self.upload_path, img_dir)
+        parent = os.path.dirname(final)
+        name = os.path.basename(final)
+        token = uuid.uuid4().hex
+        image_set = os.path.join(parent, '.sets', f'{name}-{token}')
+        os.makedirs(image_set)
+
+        for digest in dict.fromkeys(digests):
+            source = os.path.join(self.upload_path, variant_name(digest, 'web'))
+            target = os.path.join(image_set, f'{digest}.jpg')
+            try:
+                os.link(source, target)
+            except OSError:
+                shutil.copyfile(source, target)
+
+        tmp_link = os.path.join(parent, f'.{name}-{token}.link')
+        os.symlink(os.path.relpath(image_set, parent), tmp_link)
+        # the manifest only names images of the shared store, so it is written
+        # first, outside the lock since it waits on the database; on_publish
+        # returns False when a newer upload already took over. A failed write
+        # leaves the current set in place
+        try:
+            published = on_publish is None or on_publish()
+        except Exception:
+            self.discard(tmp_link, image_set)
+            raise
+        previous = None
+        with self.lock:
+            published = published and self.generations.get(pk) == generation
+            if published:
+                previous = os.path.realpath(final) if os.path.islink(final) else None
+                if os.path.isdir(final) and not os.path.islink(final):
+                    shutil.rmtree(final)
+                os.replace(tmp_link, final)
+        if not published:
+            self.discard(tmp_link, image_set)
+            return False
+        if previous: shutil.rmtree(previous, ignore_errors=True)
+        return True
+
+    @staticmethod
+    def discard(tmp_link: str, image_set: str) -> None:
+        os.unlink(tmp_link)
+        shutil.rmtree(image_set, ignore_errors=True)
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True)
+
+def get_pipeline() -> ImagePipeline:
+    pipeline = current_app.extensions.get('image_pipeline')
+    if pipeline is None or pipeline.pid != os.getpid():
+        with _pipeline_lock:
+            pipeline = current_app.extensions.get('image_pipeline')
+            if pipeline is None or pipeline.pid != os.getpid():
+                pipeline = ImagePipeline(current_app._get_current_object())
+                current_app.extensions['image_pipeline'] = pipeline
+    return pipeline
+
+# removes the products/<pk> directories of deleted products together with the
+# image sets they link to; variants in the shared store are left alone
+def remove_image_dirs(img_dirs: list) -> int:
+    upload_path = current_app.config['UPLOAD_PATH']
+    removed = 0
+    for img_dir in filter(None, img_dirs):
+        path = os.path.join(upload_path, img_dir)
+        if os.path.islink(path):
+            image_set = os.path.realpath(path)
+            os.unlink(path)
+            shutil.rmtree(image_set, ignore_errors=True)
+        elif os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            continue
+        removed += 1
+    return removed
+
+# builds manifests (and variants) for images already lying in static/products
+def index_images() -> int:
+    from app.models import Product
+
+    pipeline = get_pipeline()
+    products_dir = os.path.join(pipeline.upload_path, 'products')
+    indexed = 0
+    for name in sorted(os.listdir(products_dir), key=lambda n: n.zfill(10)):
+        directory = os.path.join(products_dir, name)
+        if not name.isdigit() or not os.path.isdir(directory): continue
+        if Product.get_by_pk(int(name)) is None: continue
+
+        images = []
+        for file_name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, file_name)
+            if not os.path.isfile(path): continue
+            try:
+                images.append(pipeline.store(path))
+            except (OSError, Image.DecompressionBombError):
+                current_app.logger.warning('Skipping unreadable image %s', path)
+        Product.save_image_manifest(int(name), images)
+        indexed += 1
+    return indexed
+
+@click.command('index-images')
+@with_appcontext
+def index_images_command():
+    indexed = index_images()
+    click.echo(f'Indexed images of {indexed} products.')
+
+def init_app(app):
+    app.cli.add_command(index_images_command)
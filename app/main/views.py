@@ -1,6 +1,7 @@
-from flask import render_template, url_for, redirect
+from flask import abort, render_template, request, url_for, redirect
 from app.main import main
-from app.models import Product
+from app.decorators import catalog_conditional
+from app.models import Product, ProductFilter, Property
 
 
 @main.route('/', methods=['GET', 'POST'])
@@ -8,11 +9,17 @@ def index():
     return render_template('index.html')
 
 @main.route('/products/<int:pk>/', methods=['GET', 'POST'])
+@catalog_conditional
 def product_detail(pk: int):
     product = Product.get_product(pk)
-    return render_template('product_detail.html', product=product)
+    if product is None: abort(404)
+    properties = Property.get_for_products([pk])[pk]
+    return render_template('product_detail.html', product=product, properties=properties)
 
 @main.route('/products', methods=['GET', 'POST'])
+@catalog_conditional
 def product_list():
-    products = Product.get_all_products()
-    return render_template('product_list.html', products=products)
+    # one keyset page at a time, the same queries as the admin list
+    product_filter = ProductFilter.from_args(request.args)
+    pagination, products, _ = Product.get_paginated(product_filter)
+    return render_template('product_list.html', products=products, pagination=pagination)
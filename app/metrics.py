@@ -0,0 +1,173 @@
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from functools import lru_cache
+from flask import current_app, g, has_app_context, has_request_context, request
+from psycopg2 import extensions
+from psycopg2.extras import DictCursor, RealDictCursor
+
+QUERY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str) -> list:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf', ), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum:.6f}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queries = {}
+        self.request_queries = {}
+        self.request_db_time = {}
+        self.slow_queries = deque(maxlen=100)
+        self.slow_total = 0
+
+    def observe_query(self, statement: str, seconds: float) -> None:
+        with self.lock:
+            if statement not in self.queries and len(self.queries) >= MAX_STATEMENTS:
+                statement = 'other'
+            histogram = self.queries.get(statement)
+            if histogram is None:
+                histogram = self.queries[statement] = Histogram(QUERY_BUCKETS)
+            histogram.observe(seconds)
+
+    def observe_slow(self, statement: str, seconds: float) -> None:
+        with self.lock:
+            self.slow_total += 1
+            self.slow_queries.append({
+                'statement': statement,
+                'ms': round(seconds * 1000, 3),
+                'endpoint': request.endpoint if has_request_context() else None,
+                'at': time.time(),
+            })
+
+    def observe_request(self, endpoint: str, queries: int, seconds: float) -> None:
+        with self.lock:
+            if endpoint not in self.request_queries:
+                self.request_queries[endpoint] = Histogram(COUNT_BUCKETS)
+                self.request_db_time[endpoint] = Histogram(QUERY_BUCKETS)
+            self.request_queries[endpoint].observe(queries)
+            self.request_db_time[endpoint].observe(seconds)
+
+    def render(self, pool_stats: dict = None) -> str:
+        lines = []
+        with self.lock:
+            families = [
+                ('pyshop_db_query_duration_seconds', 'Latency of SQL statements.',
+                    'statement', self.queries),
+                ('pyshop_request_db_queries', 'SQL statements issued per request.',
+                    'endpoint', self.request_queries),
+                ('pyshop_request_db_seconds', 'Time spent in the database per request.',
+                    'endpoint', self.request_db_time),
+            ]
+            for name, help_text, label, histograms in families:
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} histogram')
+                for key, histogram in histograms.items():
+                    lines.extend(histogram.render(name, f'{label}="{escape(key)}"'))
+
+            lines.append('# HELP pyshop_db_slow_queries_total Statements slower than SLOW_QUERY_MS.')
+            lines.append('# TYPE pyshop_db_slow_queries_total counter')
+            lines.append(f'pyshop_db_slow_queries_total {self.slow_total}')
+
+        for key, value in (pool_stats or {}).items():
+            if key == 'pid': continue
+            lines.append(f'# TYPE pyshop_db_pool_{key} gauge')
+            lines.append(f'pyshop_db_pool_{key} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+MAX_STATEMENTS = 500
+
+# literals are masked so that statements with inlined values (execute_values)
+# share one label and the number of time series stays bounded
+@lru_cache(maxsize=1024)
+def statement_label(query) -> str:
+    if isinstance(query, bytes): query = query.decode('utf-8', 'replace')
+    elif not isinstance(query, str): query = str(query)
+    return re.sub(r'\s+', ' ', LITERALS.sub('?', query)).strip()[:160]
+
+def record_query(query, seconds: float) -> None:
+    if not has_app_context(): return
+    statement = statement_label(query)
+    metrics.observe_query(statement, seconds)
+    g.db_queries = g.get('db_queries', 0) + 1
+    g.db_time = g.get('db_time', 0.0) + seconds
+
+    threshold = current_app.config['SLOW_QUERY_MS']
+    if threshold is not None and seconds * 1000 >= threshold:
+        metrics.observe_slow(statement, seconds)
+        current_app.logger.warning('Slow query (%.1f ms): %s', seconds * 1000, statement)
+
+class TimedCursorMixin:
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            seconds = time.perf_counter() - started
+            # a named cursor only declares here; its reader records the
+            # statement once, together with the FETCH round trips
+            if self.name is None: record_query(query, seconds)
+            else: self.db_time = seconds
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            record_query(sql, time.perf_counter() - started)
+
+class TimedCursor(TimedCursorMixin, extensions.cursor):
+    pass
+
+class TimedDictCursor(TimedCursorMixin, DictCursor):
+    pass
+
+class TimedRealDictCursor(TimedCursorMixin, RealDictCursor):
+    pass
+
+def start_request() -> None:
+    g.db_queries = 0
+    g.db_time = 0.0
+
+def finish_request(response):
+    queries, db_time = g.get('db_queries', 0), g.get('db_time', 0.0)
+    if request.endpoint and request.endpoint != 'static':
+        metrics.observe_request(request.endpoint, queries, db_time)
+    if current_app.config['SERVER_TIMING']:
+        response.headers.add(
+            'Server-Timing', f'db;dur={db_time * 1000:.2f};desc="{queries} queries"'
+        )
+    return response
+
+def init_app(app) -> None:
+    app.before_request(start_request)
+    app.after_request(finish_request)
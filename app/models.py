@@ -1,138 +1,687 @@
-import os
-import shutil
-import json
-from flask import current_app, jsonify
+import threading
+import time
+import uuid
+from flask import current_app
 from flask_paginate import Pagination
+from decimal import Decimal, InvalidOperation
 from typing import List, Tuple
-from psycopg2.extras import RealDictCursor, DictCursor
-from werkzeug.utils import secure_filename
-from app.db import get_db
+from psycopg2 import IntegrityError, errors, sql
+from psycopg2.extras import RealDictCursor, execute_values
+from app.cache import TTLCache
+from app.db import get_db, get_read_db, mark_write, transaction
+from app.images import get_pipeline
+from app.metrics import record_query, TimedDictCursor, TimedRealDictCursor
+from app.notify import subscribe
+from app.rows import columns, CurrentUser, ProductData, ProductListRow, ProductRef, UserListRow
+from app.serializers import dumps
 
 
+class StaleProduct(Exception):
+    pass
+
+
+# reads go to a replica when READ_DATABASES is set (see app.db.get_read_db),
+# execute_call and transactions always run on the primary
 class PgAPI:
     @staticmethod
-    def execute_query(query: str, *args):
-        cursor = get_db().cursor()
+    def _execute(connection, query, args: tuple, cursor_factory=None):
+        if isinstance(query, sql.Composable): query = query.as_string(connection)
+        cursor = connection.cursor(cursor_factory=cursor_factory)
         cursor.execute(query, args)
-        return cursor.fetchall()
+        return cursor
+
+    # row: a NamedTuple type from app.rows to build the rows as
+    @staticmethod
+    def execute_query(query: str, *args, row: type = None):
+        rows = PgAPI._execute(get_read_db(), query, args).fetchall()
+        return rows if row is None else list(map(row._make, rows))
     
     @staticmethod
     def execute_dict_query(query: str, *args):
-        cursor = get_db().cursor(cursor_factory=DictCursor)
-        cursor.execute(query, args)
-        return cursor.fetchall()
+        return PgAPI._execute(get_read_db(), query, args, TimedDictCursor).fetchall()
     
     @staticmethod
     def execute_rdict_query(query: str, *args):
-        cursor = get_db().cursor(cursor_factory=RealDictCursor)
-        cursor.execute(query, args)
-        return cursor.fetchall()
+        return PgAPI._execute(get_read_db(), query, args, TimedRealDictCursor).fetchall()
     
     @staticmethod
     def execute_call(query: str, *args):
-        cursor = get_db().cursor()
-        cursor.execute(query, args)
+        PgAPI._execute(get_db(), query, args)
+        mark_write()
+
+    @staticmethod
+    def _stream(query: str, args: tuple, cursor_factory=None, itersize: int = None):
+        # named cursors live on the server and only exist inside a transaction
+        with transaction(get_read_db()) as connection:
+            cursor = connection.cursor(
+                name=f'stream_{uuid.uuid4().hex}', cursor_factory=cursor_factory
+            )
+            cursor.itersize = itersize or current_app.config['DB_STREAM_ITERSIZE']
+            fetched = 0.0
+            try:
+                cursor.execute(query, args)
+                while True:
+                    # each fetchmany is one FETCH round trip, timed apart
+                    # from the time the consumer spends on the rows
+                    started = time.perf_counter()
+                    rows = cursor.fetchmany(cursor.itersize)
+                    fetched += time.perf_counter() - started
+                    if not rows: break
+                    yield from rows
+            finally:
+                cursor.close()
+                # timed cursors leave the DECLARE time, see TimedCursorMixin
+                declared = getattr(cursor, 'db_time', None)
+                if declared is not None: record_query(query, declared + fetched)
+
+    @staticmethod
+    def stream_query(query: str, *args, itersize: int = None):
+        return PgAPI._stream(query, args, itersize=itersize)
+
+    @staticmethod
+    def stream_dict_query(query: str, *args, itersize: int = None):
+        return PgAPI._stream(query, args, TimedDictCursor, itersize)
+
+    @staticmethod
+    def stream_rdict_query(query: str, *args, itersize: int = None):
+        return PgAPI._stream(query, args, TimedRealDictCursor, itersize)
     
+class ReferenceData:
+    # name -> (query, tables the data is built from, rows -> data)
+    registry = {}
+    # name -> (versions of its tables, data)
+    cache = {}
+    versions = {}
+    checked_at = 0.0
+    lock = threading.Lock()
+
+    @staticmethod
+    def register(name: str, query: str, tables: List[str], transform=list) -> None:
+        ReferenceData.registry[name] = (query, tuple(tables), transform)
+
+    @staticmethod
+    def get_versions() -> dict:
+        interval = current_app.config['REFDATA_CHECK_INTERVAL']
+        if time.monotonic() - ReferenceData.checked_at > interval:
+            rows = PgAPI.execute_query('SELECT table_name, version FROM ref_versions')
+            with ReferenceData.lock:
+                ReferenceData.versions = dict(rows)
+                ReferenceData.checked_at = time.monotonic()
+        return ReferenceData.versions
+
+    @staticmethod
+    def get(name: str):
+        query, tables, transform = ReferenceData.registry[name]
+        versions = ReferenceData.get_versions()
+        key = tuple(versions.get(table, 0) for table in tables)
+        cached = ReferenceData.cache.get(name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        data = transform(PgAPI.execute_query(query))
+        with ReferenceData.lock:
+            ReferenceData.cache[name] = (key, data)
+        return data
+
+    @staticmethod
+    def refresh(name: str = None) -> None:
+        with ReferenceData.lock:
+            if name is None: ReferenceData.cache.clear()
+            else: ReferenceData.cache.pop(name, None)
+            ReferenceData.checked_at = 0.0
+
+    @staticmethod
+    def expire_versions(table: str = None) -> None:
+        ReferenceData.checked_at = 0.0
+
+class Catalog:
+    version = None
+    stock_version = None
+    query = """
+        SELECT (SELECT version FROM ref_versions WHERE table_name = 'catalog'),
+               (SELECT updated_at FROM ref_versions WHERE table_name = 'catalog'),
+               coalesce(sum(version), 0), max(updated_at)
+        FROM stock_versions
+    """
+
+    @staticmethod
+    def get_version(stock: bool = True) -> tuple:
+        # (version, updated_at) of everything product pages are built from;
+        # with stock the version is a (catalog, stock) pair, for the pages
+        # that show units_in_stock or the product version
+        version, updated_at, stock_version, stock_updated_at = \
+            PgAPI.execute_query(Catalog.query)[0]
+        version = version or 0
+        if version != Catalog.version:
+            # another worker changed the catalog: a response tagged with the
+            # new version must not be built from rows cached under the old one
+            if Catalog.version is not None:
+                Product.invalidate_pages()
+                Product.invalidate_rows()
+            Catalog.version = version
+        if stock_version != Catalog.stock_version:
+            # pages filtered by stock are keyed by the stock version already
+            if Catalog.stock_version is not None: Product.invalidate_rows()
+            Catalog.stock_version = stock_version
+        if not stock: return version, updated_at
+        updated_at = max(filter(None, (updated_at, stock_updated_at)), default=None)
+        return (version, stock_version), updated_at
+
+def as_choices(rows) -> List[Tuple[int, str]]:
+    return [(el[0], el[1]) for el in rows]
+
 class Supplier:
     @staticmethod
     def get_all_choices() -> List[Tuple[int, str]]:
-        query = 'SELECT * FROM v_suppliers_names_all'
-        suppliers = PgAPI.execute_query(query)
-        return [(el[0], el[1]) for el in suppliers]
+        return ReferenceData.get('supplier_choices')
 
 class Category:
     @staticmethod
     def get_all_choices() -> List[Tuple[int, str]]:
-        query = 'SELECT * FROM v_categories_names_all'
-        categories = PgAPI.execute_query(query)
-        return [(el[0], el[1]) for el in categories]
+        return ReferenceData.get('category_choices')
+
+class Property:
+    @staticmethod
+    def get_by_category(category_id: int) -> List[Tuple[int, str]]:
+        return ReferenceData.get('category_properties').get(category_id, [])
+
+    @staticmethod
+    def get_for_products(pks: List[int]) -> dict:
+        # product_id -> [(property_name, value)] for a whole page in one
+        # query: the properties of its category in order, missing values as
+        # None, then any values outside the category
+        names = ReferenceData.get('property_names')
+        categories, values = {}, {}
+        query = 'SELECT * FROM get_properties_for_products(%s)'
+        for pk, category_id, property_id, value in PgAPI.execute_query(query, list(pks)):
+            categories[pk] = category_id
+            values.setdefault(pk, {})
+            if property_id is not None: values[pk][property_id] = value
+
+        properties = {}
+        for pk in pks:
+            if pk not in categories: continue
+            product_values = dict(values[pk])
+            properties[pk] = [
+                (name, product_values.pop(property_id, None))
+                for property_id, name in Property.get_by_category(categories[pk])
+            ] + [
+                (names.get(property_id), value) for property_id, value in product_values.items()
+            ]
+        return properties
+
+def group_category_properties(rows) -> dict:
+    categories = {}
+    for category_id, property_id, property_name in rows:
+        categories.setdefault(category_id, []).append((property_id, property_name))
+    return categories
+
+ReferenceData.register(
+    'supplier_choices', 'SELECT * FROM v_suppliers_names_all',
+    ['suppliers'], as_choices
+)
+ReferenceData.register(
+    'category_choices', 'SELECT * FROM v_categories_names_all',
+    ['categories'], as_choices
+)
+ReferenceData.register(
+    'category_properties', """
+        SELECT category_id, property_id, property_name
+        FROM category_properties
+          JOIN properties USING (property_id)
+        ORDER BY category_id, property_name
+    """,
+    ['category_properties', 'properties'], group_category_properties
+)
+ReferenceData.register(
+    'property_names', 'SELECT property_id, property_name FROM properties',
+    ['properties'], dict
+)
+
+def parse_price(value: str) -> Decimal:
+    try:
+        price = Decimal(value.strip()).quantize(Decimal('0.01'))
+    except (AttributeError, InvalidOperation):
+        return None
+    return None if price.is_nan() or price < 0 else price
+
+def format_price(price: Decimal) -> str:
+    # one spelling per amount, so 10, 10.0 and 1E1 share a URL
+    return format(price.normalize(), 'f')
+
+# product list state as it travels in the URL: the same filter always maps
+# to the same canonical query string and to the same SQL
+class ProductFilter:
+    modes = ('search', 'name', 'category')
+    # sort name -> (column, descending); search defaults to relevance
+    sorts = {
+        'id': ('product_id', False),
+        '-id': ('product_id', True),
+        'name': ('product_name', False),
+        '-name': ('product_name', True),
+        'price': ('unit_price', False),
+        '-price': ('unit_price', True),
+    }
+    columns = ProductListRow._fields
+    # bounds of the price facet buckets, see price_range
+    price_bounds = (50, 100, 250, 500, 1000)
+
+    def __init__(self, mode: str = None, q: str = '', category_id: int = None,
+                 supplier_id: int = None, price_min: Decimal = None,
+                 price_max: Decimal = None, in_stock: bool = False,
+                 properties: dict = None, sort: str = None, page: int = 1):
+        self.q = (q or '').strip()[:100]
+        self.mode = (mode if mode in self.modes else 'search') if self.q else None
+        self.category_id = category_id
+        self.supplier_id = supplier_id
+        self.price_min = price_min
+        self.price_max = price_max
+        self.in_stock = bool(in_stock)
+        # property_id -> value, ordered so that the URL is canonical
+        self.properties = {
+            pk: value.strip()[:40] for pk, value in sorted((properties or {}).items())
+            if value and value.strip()
+        }
+        self.sort = sort if sort in self.sorts else None
+        if self.sort == 'id' and self.mode != 'search': self.sort = None
+        self.page = max(page or 1, 1)
+
+    @classmethod
+    def from_args(cls, args) -> 'ProductFilter':
+        # property values travel as p<property_id>=<value>
+        properties = {
+            int(name[1:]): value for name, value in args.items()
+            if name[:1] == 'p' and name[1:].isdigit()
+        }
+        return cls(
+            mode=args.get('mode'),
+            q=args.get('q', ''),
+            category_id=args.get('category_id', type=int),
+            supplier_id=args.get('supplier_id', type=int),
+            price_min=parse_price(args.get('price_min')),
+            price_max=parse_price(args.get('price_max')),
+            in_stock=bool(args.get('in_stock')),
+            properties=properties,
+            sort=args.get('sort'),
+            page=args.get('page', type=int, default=1)
+        )
+
+    def to_args(self, page: int = None) -> dict:
+        args = {}
+        if self.mode: args.update(mode=self.mode, q=self.q)
+        if self.category_id is not None: args['category_id'] = self.category_id
+        if self.supplier_id is not None: args['supplier_id'] = self.supplier_id
+        if self.price_min is not None: args['price_min'] = format_price(self.price_min)
+        if self.price_max is not None: args['price_max'] = format_price(self.price_max)
+        if self.in_stock: args['in_stock'] = 'y'
+        for pk, value in self.properties.items(): args[f'p{pk}'] = value
+        if self.sort: args['sort'] = self.sort
+        page = self.page if page is None else page
+        if page > 1: args['page'] = page
+        return args
+
+    def replace(self, **changes) -> 'ProductFilter':
+        # the first page of this filter with some fields changed
+        fields = dict(
+            mode=self.mode, q=self.q, category_id=self.category_id,
+            supplier_id=self.supplier_id, price_min=self.price_min,
+            price_max=self.price_max, in_stock=self.in_stock,
+            properties=self.properties, sort=self.sort
+        )
+        fields.update(changes)
+        return ProductFilter(**fields)
+
+    def with_property(self, pk: int, value: str = None) -> 'ProductFilter':
+        properties = dict(self.properties)
+        properties[pk] = value
+        return self.replace(properties=properties)
+
+    def price_range(self, bucket: int) -> Tuple[Decimal, Decimal]:
+        # width_bucket numbering: 0 is below the first bound, len(bounds)
+        # above the last; price_max is inclusive, so stop a cent short
+        bounds = (None, ) + self.price_bounds + (None, )
+        low, high = bounds[bucket], bounds[bucket + 1]
+        return (
+            None if low is None else Decimal(low),
+            None if high is None else Decimal(high) - Decimal('0.01')
+        )
+
+    @property
+    def key(self) -> tuple:
+        return (
+            self.mode, self.q, self.category_id, self.supplier_id, self.price_min,
+            self.price_max, self.in_stock, tuple(self.properties.items()), self.sort
+        )
+
+    @property
+    def order(self) -> Tuple[str, bool]:
+        return self.sorts[self.sort or 'id']
+
+    def filters(self) -> dict:
+        # group -> (conditions on products p, params); a facet is counted
+        # without its own group, so the other choices in it stay visible
+        filters = {group: ([], []) for group in ('base', 'category', 'supplier', 'price')}
+
+        def add(group: str, condition: str, *params) -> None:
+            filters[group][0].append(sql.SQL(condition))
+            filters[group][1].extend(params)
+
+        if self.mode == 'name':
+            add('base', '(p.product_name ILIKE %s OR p.sku ILIKE %s)', self.q + '%', self.q + '%')
+        elif self.mode == 'category':
+            add('base', """p.category_id IN (
+                SELECT category_id FROM categories WHERE category_name ILIKE %s
+            )""", self.q + '%')
+        if self.in_stock:
+            add('base', 'p.units_in_stock > 0')
+        for pk, value in self.properties.items():
+            add('base', """EXISTS (
+                SELECT 1 FROM product_properties pp
+                WHERE pp.property_id = %s AND pp.property_value = %s
+                  AND pp.product_id = p.product_id
+            )""", pk, value)
+        if self.category_id is not None:
+            add('category', 'p.category_id = %s', self.category_id)
+        if self.supplier_id is not None:
+            add('supplier', 'p.supplier_id = %s', self.supplier_id)
+        if self.price_min is not None:
+            add('price', 'p.unit_price >= %s', self.price_min)
+        if self.price_max is not None:
+            add('price', 'p.unit_price <= %s', self.price_max)
+        return filters
+
+    def conditions(self) -> Tuple[list, list]:
+        conditions, params = [], []
+        for group_conditions, group_params in self.filters().values():
+            conditions.extend(group_conditions)
+            params.extend(group_params)
+        return conditions, params
+
+    @staticmethod
+    def where(conditions: list) -> sql.Composable:
+        if not conditions: return sql.SQL('')
+        return sql.SQL(' WHERE ') + sql.SQL(' AND ').join(conditions)
+
+    @staticmethod
+    def holds(conditions: list) -> sql.Composable:
+        if not conditions: return sql.SQL('true')
+        return sql.SQL('(') + sql.SQL(' AND ').join(conditions) + sql.SQL(')')
+
+    def select(self, alias: str, exclude: tuple = ()) -> sql.Composable:
+        return sql.SQL(', ').join(
+            sql.Identifier(alias, column) for column in self.columns if column not in exclude
+        )
+
+    def order_by(self, alias: str) -> sql.Composable:
+        column, descending = self.order
+        direction = sql.SQL(' DESC' if descending else '')
+        order_by = [sql.Identifier(alias, column) + direction]
+        if column != 'product_id': order_by.append(sql.Identifier(alias, 'product_id') + direction)
+        return sql.SQL(', ').join(order_by)
+
+    def page_query(self, after: tuple, offset: int, limit: int) -> Tuple[sql.Composable, list]:
+        # keyset seek on (sort column, product_id) past the row in after
+        conditions, params = self.conditions()
+        column, descending = self.order
+        if after is not None:
+            operator = sql.SQL('<' if descending else '>')
+            if column == 'product_id':
+                conditions.append(sql.SQL('p.product_id {} %s').format(operator))
+                params.append(after[1])
+            else:
+                conditions.append(sql.SQL('({}, p.product_id) {} (%s, %s)').format(
+                    sql.Identifier('p', column), operator
+                ))
+                params.extend(after)
+
+        query = sql.SQL('SELECT {} FROM v_products_filter p{} ORDER BY {} OFFSET %s LIMIT %s').format(
+            self.select('p'), self.where(conditions), self.order_by('p')
+        )
+        return query, params + [offset, limit]
+
+    def facets_ctes(self, source: sql.Composable, source_params: list,
+                    columns: sql.Composable) -> Tuple[sql.Composable, list]:
+        # "matched" holds the rows passing the base filters, flagged with
+        # the facet groups they pass; "facets" counts them in one JSON object
+        filters = self.filters()
+        conditions, params = filters['base']
+        facets = [sql.SQL("""
+            'total', (
+                SELECT count(*) FROM matched
+                WHERE in_category AND in_supplier AND in_price
+            ),
+            'categories', (
+                SELECT coalesce(json_agg(json_build_object(
+                    'id', category_id, 'name', category_name, 'count', n
+                ) ORDER BY n DESC, category_name), '[]')
+                FROM (
+                    SELECT category_id, count(*) AS n FROM matched
+                    WHERE in_supplier AND in_price GROUP BY category_id
+                ) f JOIN categories USING (category_id)
+            ),
+            'suppliers', (
+                SELECT coalesce(json_agg(json_build_object(
+                    'id', supplier_id, 'name', company_name, 'count', n
+                ) ORDER BY n DESC, company_name), '[]')
+                FROM (
+                    SELECT supplier_id, count(*) AS n FROM matched
+                    WHERE in_category AND in_price GROUP BY supplier_id
+                ) f JOIN suppliers USING (supplier_id)
+            ),
+            'prices', (
+                SELECT coalesce(json_agg(json_build_object(
+                    'bucket', bucket, 'count', n
+                ) ORDER BY bucket), '[]')
+                FROM (
+                    SELECT width_bucket(unit_price, %s::numeric[]) AS bucket, count(*) AS n
+                    FROM matched WHERE in_category AND in_supplier GROUP BY 1
+                ) f
+            )
+        """)]
+        facet_params = [list(self.price_bounds)]
+        # property values are only comparable within one category
+        if self.category_id is not None:
+            facets.append(sql.SQL("""
+                'properties', (
+                    SELECT coalesce(json_agg(json_build_object(
+                        'id', property_id, 'name', property_name,
+                        'value', property_value, 'count', n
+                    ) ORDER BY property_name, n DESC, property_value), '[]')
+                    FROM (
+                        SELECT property_id, property_value, count(*) AS n
+                        FROM matched
+                          JOIN product_properties USING (product_id)
+                        WHERE in_category AND in_supplier AND in_price
+                        GROUP BY property_id, property_value
+                    ) f JOIN properties USING (property_id)
+                )
+            """))
+
+        query = sql.SQL("""
+            matched AS (
+                SELECT {columns}, p.category_id, p.supplier_id, p.unit_price,
+                       {in_category} AS in_category,
+                       {in_supplier} AS in_supplier,
+                       {in_price} AS in_price
+                FROM {source}{where}
+            ), facets AS (
+                SELECT json_build_object({facets}) AS facets
+            )
+        """).format(
+            columns=columns,
+            in_category=self.holds(filters['category'][0]),
+            in_supplier=self.holds(filters['supplier'][0]),
+            in_price=self.holds(filters['price'][0]),
+            source=source, where=self.where(conditions),
+            facets=sql.SQL(', ').join(facets)
+        )
+        flag_params = filters['category'][1] + filters['supplier'][1] + filters['price'][1]
+        return query, flag_params + source_params + params + facet_params
+
+    def page_facets_query(self, after: tuple, offset: int,
+                          limit: int) -> Tuple[sql.Composable, list]:
+        # page_query and its facets in one round trip; an empty page still
+        # returns one row, holding the facets and no product
+        ctes, params = self.facets_ctes(sql.SQL('products p'), [], sql.SQL('p.product_id'))
+        page_query, page_params = self.page_query(after, offset, limit)
+        query = sql.SQL("""
+            WITH {ctes}, page AS ({page_query})
+            SELECT {columns}, facets.facets
+            FROM facets LEFT JOIN page ON true
+            ORDER BY {order_by}
+        """).format(
+            ctes=ctes, page_query=page_query,
+            columns=self.select('page'), order_by=self.order_by('page')
+        )
+        return query, params + page_params
+
+    def search_query(self, offset: int, limit: int,
+                     search_limit: int) -> Tuple[sql.Composable, list]:
+        # at most search_limit ranked rows, narrowed, counted and sorted here
+        ctes, params = self.facets_ctes(
+            sql.SQL('search_products(%s, %s) WITH ORDINALITY AS s JOIN products p USING (product_id)'),
+            [self.q, search_limit],
+            self.select('s', exclude=('unit_price', )) + sql.SQL(', s.ordinality')
+        )
+        order_by = self.order_by('page') if self.sort else sql.SQL('page.ordinality')
+        query = sql.SQL("""
+            WITH {ctes}, page AS (
+                SELECT * FROM matched m
+                WHERE in_category AND in_supplier AND in_price
+                ORDER BY {page_order} OFFSET %s LIMIT %s
+            )
+            SELECT {columns}, facets.facets
+            FROM facets LEFT JOIN page ON true
+            ORDER BY {order_by}
+        """).format(
+            ctes=ctes, columns=self.select('page'), order_by=order_by,
+            page_order=self.order_by('m') if self.sort else sql.SQL('m.ordinality')
+        )
+        return query, params + [offset, limit]
 
 class Product:
-    per_page = 3
-    last_query = ''
-    last_option = ''
+    facets = TTLCache(maxsize=256)
+    page_bounds = TTLCache(maxsize=256)
+    rows = TTLCache(maxsize=4096)
+    # numeric is cast in SQL so rows serialize as plain JSON numbers
+    batch_query = f"""
+        SELECT {columns(ProductData, unit_price='unit_price::float8')}
+        FROM products
+        WHERE product_id = ANY(%s)
+    """
 
     @staticmethod
-    def get_all() -> DictCursor:
-        query = 'SELECT * FROM v_products_all'
-        products = PgAPI.execute_dict_query(query)
-        return products
+    def get_product(pk: int) -> ProductData:
+        return Product.get_many([pk]).get(pk)
+
+    @staticmethod
+    def stream_all():
+        query = 'SELECT * FROM v_products_all ORDER BY product_id'
+        return PgAPI.stream_rdict_query(query)
 
     @staticmethod
-    def get_by_sku(sku: str) -> DictCursor:
-        query = 'SELECT * FROM products WHERE sku = %s'
-        product = PgAPI.execute_query(query, (sku, ))
+    def get_by_sku(sku: str) -> ProductRef:
+        query = f'SELECT {columns(ProductRef)} FROM products WHERE sku = %s'
+        product = PgAPI.execute_query(query, sku, row=ProductRef)
         return product[0] if product else None
     
     @staticmethod
-    def get_by_pk(pk: int):
-        query = 'SELECT * FROM products WHERE product_id=%s'
-        product = PgAPI.execute_query(query, (pk, ))
+    def get_by_pk(pk: int) -> ProductRef:
+        query = f'SELECT {columns(ProductRef)} FROM products WHERE product_id = %s'
+        product = PgAPI.execute_query(query, pk, row=ProductRef)
         return product[0] if product else None
 
+    @staticmethod
+    def get_many(pks: List[int]) -> dict:
+        products = {}
+        missing = []
+        for pk in pks:
+            product = Product.rows.get(pk)
+            if product is None: missing.append(pk)
+            else: products[pk] = product
+
+        if missing:
+            ttl = current_app.config['PRODUCT_CACHE_TTL']
+            for product in PgAPI.execute_query(Product.batch_query, missing, row=ProductData):
+                Product.rows.set(product.product_id, product, ttl=ttl)
+                products[product.product_id] = product
+        return products
+
     @staticmethod
     def get_json(pk: int):
-        product = Product.get_by_pk(pk)
-        pairs = zip(
-            [
-                'category_id', 'supplier_id', 'product_name',
-                'sku', 'description', 'unit_price', 
-                'discount', 'units_in_stock'
-            ],
-            product[1:9]
-        )
-        data = dict(pairs)
-        response = json.dumps(data, ensure_ascii=False, default=str)
-        return response
+        product = Product.get_many([pk]).get(pk)
+        if product is None: return None
+        data = product._asdict()
+        del data['product_id']
+        return dumps(data)
     
     @staticmethod
-    def get_by_name_like(name: str) -> DictCursor:
-        query = 'SELECT * FROM get_products_by_name(%s)'
-        products = PgAPI.execute_dict_query(query, name)
-        return products
-    
+    def get_filtered_page(product_filter: ProductFilter,
+                          per_page: int) -> Tuple[dict, List[ProductListRow]]:
+        # seek from the closest page whose last row is already known and
+        # skip only the pages in between, so sequential browsing never scans
+        page = product_filter.page
+        # stock moves do not clear these caches, so what in_stock matches is
+        # cached per stock version
+        filter_key = product_filter.key
+        if product_filter.in_stock: filter_key += (Catalog.stock_version, )
+        key = (filter_key, per_page)
+        bounds = Product.page_bounds.get(key, {})
+        start = max((p for p in bounds if p < page), default=0)
+        after = bounds[start] if start else None
+        offset = (page - 1 - start) * per_page
+
+        # facets cost a pass over every match, so they are fetched with the
+        # first page viewed and then reused while they are fresh
+        facets = Product.facets.get(filter_key)
+        if facets is None:
+            query, params = product_filter.page_facets_query(after, offset, per_page)
+            facets, products = Product.split_facets(PgAPI.execute_query(query, *params))
+            Product.facets.set(filter_key, facets,
+                ttl=current_app.config['PRODUCTS_COUNT_TTL'])
+        else:
+            query, params = product_filter.page_query(after, offset, per_page)
+            products = PgAPI.execute_query(query, *params, row=ProductListRow)
+        if products:
+            column, _ = product_filter.order
+            bounds = dict(bounds)
+            bounds[page] = (getattr(products[-1], column), products[-1].product_id)
+            Product.page_bounds.set(key, bounds)
+        return facets, products
+
+    # the facets come last in every row, after the ProductListRow columns
     @staticmethod
-    def get_by_category_like(category: str) -> DictCursor:
-        query = 'SELECT * FROM get_products_by_category(%s)'
-        products = PgAPI.execute_dict_query(query, category)
-        return products
-    
+    def split_facets(rows: list) -> Tuple[dict, List[ProductListRow]]:
+        return rows[0][-1], [ProductListRow._make(row[:-1]) for row in rows if row[0] is not None]
+
     @staticmethod
-    def get_by_price_like(lower: float, higher: float) -> DictCursor:
-        query = 'SELECT * FROM get_products_by_price(%s, %s)'
-        products = PgAPI.execute_dict_query(query, lower, higher)
-        return products
-    
+    def invalidate_pages() -> None:
+        Product.facets.clear()
+        Product.page_bounds.clear()
+
     @staticmethod
-    def paginate_queryset(query_set, page) -> Tuple[int, DictCursor]:
-        total = len(query_set)
-        offset = (page - 1) * Product.per_page
-        query_set = query_set[offset: offset + Product.per_page]
-        return total, query_set
+    def invalidate_rows(pks: List[int] = None) -> None:
+        if pks is None: Product.rows.clear()
+        else:
+            for pk in pks: Product.rows.pop(pk)
         
     @staticmethod
-    def get_paginated_by(data, request_args):
-        q = request_args.get('q')
-        search = q is not None
-        page = request_args.get('page', type=int, default=1)
-        value = int(data['value'])
-        Product.last_option = value
-
-        print(value)
+    def get_paginated(product_filter: ProductFilter):
+        per_page = current_app.config['PRODUCTS_PER_PAGE']
+        page = product_filter.page
 
-        if not value: products = Product.get_all()
+        if product_filter.mode == 'search':
+            query, params = product_filter.search_query(
+                (page - 1) * per_page, per_page, current_app.config['SEARCH_LIMIT']
+            )
+            facets, query_set = Product.split_facets(PgAPI.execute_query(query, *params))
         else:
-            query = data['query']
-            Product.last_query = query
-            if value == 1:
-                products = Product.get_by_name_like(query)
-            else: products = Product.get_by_category_like(query)
-
-        total, query_set = Product.paginate_queryset(products, page)
-        pagination = pagination = Pagination(page=page, total=total, search=search, 
-            css_framework='foundation', per_page=Product.per_page)
-        
-        return pagination, query_set
+            facets, query_set = Product.get_filtered_page(product_filter, per_page)
+        total = facets['total']
+        pagination = Pagination(page=page, total=total, search=bool(product_filter.q),
+            found=total, css_framework='foundation', per_page=per_page)
+
+        return pagination, query_set, facets
 
     @staticmethod
     def save_product(*product_data) -> None:
@@ -143,72 +692,269 @@ class Product:
             );
         """
         PgAPI.execute_call(query, *product_data)
+        Product.invalidate_pages()
     
+    # the last value is the version the form was filled from; StaleProduct
+    # means the product changed since then and nothing was written
     @staticmethod
     def update_product(*product_data) -> None:
         query = """
             CALL update_product(
                 %s, %s, %s, %s::varchar(40), %s::varchar(20), 
-                %s::numeric(15, 6), %s::real, %s, %s::text
+                %s::numeric(15, 6), %s::real, %s, %s::text, %s
             );
         """
-        PgAPI.execute_call(query, *product_data)
+        try:
+            PgAPI.execute_call(query, *product_data)
+        except errors.SerializationFailure as e:
+            Product.invalidate_rows([product_data[0]])
+            raise StaleProduct(e.diag.message_primary) from e
+        Product.invalidate_pages()
+        Product.invalidate_rows([product_data[0]])
     
     @staticmethod
-    def delete(pk: int) -> None:
+    # False when orders or pending reservations still reference the product
+    def delete(pk: int) -> bool:
         query = 'DELETE FROM products WHERE product_id=%s'
-        PgAPI.execute_call(query, pk)
-    
-    @staticmethod
-    def rm_dir_content(directory: str) -> None:
-        for file in os.listdir(directory):
-            os.remove(os.path.join(directory, file))
+        try:
+            PgAPI.execute_call(query, pk)
+        except IntegrityError:
+            return False
+        Product.invalidate_pages()
+        Product.invalidate_rows([pk])
+        return True
     
     @staticmethod
     def save_images(images, sku: str) -> None:
         if not images[0].filename: return
 
         product = Product.get_by_sku(sku)
-        img_dir = product[-1] 
-        dir_path = os.path.join(current_app.config['UPLOAD_PATH'], img_dir)
+        pipeline = get_pipeline()
+        spooled = pipeline.spool(images)
+        pipeline.submit(product.product_id, product.pictures_directory, spooled,
+            Product.save_image_manifest)
 
-        if os.path.exists(dir_path):
-            Product.rm_dir_content(dir_path)
-        else: os.mkdir(dir_path)
+    # is_current is asked with the product locked, so manifests of one product
+    # are written one at a time and an older upload never commits over a newer
+    @staticmethod
+    def save_image_manifest(pk: int, images: List[dict], is_current=None) -> bool:
+        with transaction() as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                'SELECT 1 FROM products WHERE product_id = %s FOR NO KEY UPDATE', (pk, )
+            )
+            if is_current is not None and not is_current(): return False
+            cursor.execute('DELETE FROM product_images WHERE product_id = %s', (pk, ))
+            execute_values(cursor, """
+                INSERT INTO product_images (
+                    product_id, position, image_hash,
+                    image_path, width, height,
+                    thumb_path, thumb_width, thumb_height
+                ) VALUES %s
+            """, [
+                (
+                    pk, position, image['hash'],
+                    image['image_path'], image['width'], image['height'],
+                    image['thumb_path'], image['thumb_width'], image['thumb_height']
+                ) for position, image in enumerate(images)
+            ])
+        return True
 
-        for image in images:
-            file_name = secure_filename(image.filename)
-            image.save(os.path.join(dir_path, file_name))
+    @staticmethod
+    def get_image_manifests(pks: List[int]) -> dict:
+        query = """
+            SELECT product_id, image_path, width, height,
+                   thumb_path, thumb_width, thumb_height, updated_at
+            FROM product_images
+            WHERE product_id = ANY(%s)
+            ORDER BY product_id, position
+        """
+        manifests = {pk: [] for pk in pks}
+        for image in PgAPI.execute_rdict_query(query, list(pks)):
+            manifests[image.pop('product_id')].append(image)
+        return manifests
 
 class User:
     per_page = 10
+    cache = TTLCache(maxsize=1024)
+    # searching or not -> (page query, count query)
+    page_queries = {
+        False: (
+            f'SELECT {columns(UserListRow)} FROM get_users_page(%s, %s, %s)',
+            'SELECT count_users(%s)'
+        ),
+        True: (
+            f'SELECT {columns(UserListRow)} FROM get_users_matching_page(%s, %s, %s, %s)',
+            'SELECT count_users_matching(%s)'
+        ),
+    }
+    counts = TTLCache(maxsize=256)
+    page_bounds = TTLCache(maxsize=256)
 
     @staticmethod
-    def get_by_email(email: str) -> RealDictCursor:
-        query = 'SELECT * FROM users WHERE email = %s'
-        user = PgAPI.execute_rdict_query(query, email)
+    def get_by_email(email: str) -> CurrentUser:
+        query = f'SELECT {columns(CurrentUser)} FROM users WHERE email = %s'
+        user = PgAPI.execute_query(query, email, row=CurrentUser)
         return user[0] if user else None
+
+    @staticmethod
+    def get_cached(email: str) -> CurrentUser:
+        user = User.cache.get(email)
+        if user is None:
+            user = User.get_by_email(email)
+            if user is not None:
+                User.cache.set(email, user, ttl=current_app.config['USER_CACHE_TTL'])
+        return user
+
+    @staticmethod
+    def invalidate(email: str = None) -> None:
+        if email is None: User.cache.clear()
+        else: User.cache.pop(email)
     
     @staticmethod
     def is_valid_login(email: str, password: str) -> bool:
-        user = User.get_by_email(email)
-        return user and user['password'] == password 
+        user = PgAPI.execute_query('SELECT password FROM users WHERE email = %s', email)
+        return bool(user) and user[0][0] == password
 
     @staticmethod
     def save_user(*user_data: List[str]) -> None:
         query = 'CALL create_user(%s, %s, %s, %s, %s)'
         PgAPI.execute_call(query, *user_data)
+        User.invalidate(user_data[0])
+
+    @staticmethod
+    def set_admin(email: str, is_admin: bool) -> None:
+        query = 'UPDATE users SET is_admin = %s WHERE email = %s'
+        PgAPI.execute_call(query, is_admin, email)
+        User.invalidate(email)
     
     @staticmethod
-    def get_all_users():
-        query = 'SELECT * FROM v_all_users'
-        return PgAPI.execute_query(query)
+    def get_all_users() -> List[UserListRow]:
+        query = f'SELECT {columns(UserListRow)} FROM v_users_all'
+        return PgAPI.execute_query(query, row=UserListRow)
     
     @staticmethod
-    def get_paginated_users(page: int) -> Tuple[int, DictCursor]:
-        offset = (page - 1) * User.per_page
-        query = 'SELECT * FROM get_paginated_users(%s, %s)'
-        query_set = PgAPI.execute_dict_query(query, User.per_page, offset)
-        total_count = PgAPI.execute_query('SELECT count(*) FROM users')[0][0]
+    def stream_all():
+        query = """
+            SELECT user_id, first_name, last_name,
+                   email, phone, birth_date, entered_date, is_admin
+            FROM users LEFT JOIN
+              customers USING (customer_id)
+            ORDER BY user_id
+        """
+        return PgAPI.stream_rdict_query(query)
+    
+    @staticmethod
+    def get_version() -> tuple:
+        query = """
+            SELECT table_name, version FROM ref_versions
+            WHERE table_name IN ('users', 'customers')
+            ORDER BY table_name
+        """
+        return tuple(tuple(row) for row in PgAPI.execute_query(query))
+
+    @staticmethod
+    def count(query: str = '', exact: bool = False, version: tuple = None) -> int:
+        if not query and exact:
+            return PgAPI.execute_query(User.page_queries[False][1], True)[0][0]
+
+        # keyed by the user data version like the rendered pages, so a page
+        # rendered for a new version never reuses an old total
+        key = (query, version or User.get_version())
+        total = User.counts.get(key)
+        if total is None:
+            total = PgAPI.execute_query(User.page_queries[bool(query)][1], query or False)[0][0]
+            User.counts.set(key, total, ttl=current_app.config['USERS_COUNT_TTL'])
+        return total
+
+    @staticmethod
+    def get_page(query: str, page: int, per_page: int,
+                 version: tuple = None) -> List[UserListRow]:
+        # seek from the closest page whose last user_id is known, as
+        # Product.get_filtered_page does; bounds are keyed by the version
+        # because other workers add and remove users
+        key = (query, per_page, version or User.get_version())
+        bounds = User.page_bounds.get(key, {})
+        start = max((p for p in bounds if p < page), default=0)
+        after_id = bounds[start] if start else 0
+        offset = (page - 1 - start) * per_page
+
+        args = (query, ) if query else ()
+        users = PgAPI.execute_query(
+            User.page_queries[bool(query)][0], *args, after_id, offset, per_page, row=UserListRow
+        )
+        if users:
+            bounds = dict(bounds)
+            bounds[page] = users[-1].user_id
+            User.page_bounds.set(key, bounds, ttl=current_app.config['USERS_COUNT_TTL'])
+        return users
+
+    @staticmethod
+    def get_paginated_users(page: int, query: str = '', exact: bool = False,
+                            version: tuple = None) -> Tuple[int, List[UserListRow]]:
+        query = query.strip()
+        version = version or User.get_version()
+        total_count = User.count(query, exact, version)
+        query_set = User.get_page(query, max(page, 1), User.per_page, version)
         return (total_count, query_set)
 
+class Order:
+    @staticmethod
+    def create(customer_id: int, lines: List[Tuple[int, int]]) -> int:
+        # lines are (product_id, quantity); one CALL writes the order and
+        # all of its lines with the order discount computed once
+        query = 'CALL create_order(%s, %s::int[], %s::int[])'
+        product_ids = [product_id for product_id, _ in lines]
+        quantities = [quantity for _, quantity in lines]
+        cursor = PgAPI._execute(get_db(), query, (customer_id, product_ids, quantities))
+        mark_write()
+        return cursor.fetchone()[0]
+
+    @staticmethod
+    def get_details(order_id: int) -> RealDictCursor:
+        query = """
+            SELECT product_id, product_name, quantity,
+                   unit_price, discount
+            FROM order_details
+              JOIN products USING (product_id)
+            WHERE order_id = %s
+        """
+        return PgAPI.execute_rdict_query(query, order_id)
+
+class Sales:
+    # reads the trigger-maintained aggregates, never order_details itself
+    @staticmethod
+    def top_customers(limit: int = 20) -> RealDictCursor:
+        query = """
+            SELECT customer_id, first_name, last_name, email,
+                   orders, items, total::float8 AS total
+            FROM customer_spend
+              JOIN customers USING (customer_id)
+              LEFT JOIN users USING (customer_id)
+            ORDER BY total DESC
+            LIMIT %s
+        """
+        return PgAPI.execute_rdict_query(query, limit)
+
+    @staticmethod
+    def by_category() -> RealDictCursor:
+        query = """
+            SELECT category_id, category_name, items, revenue::float8 AS revenue
+            FROM category_sales
+              JOIN categories USING (category_id)
+            ORDER BY revenue DESC
+        """
+        return PgAPI.execute_rdict_query(query)
+
+    @staticmethod
+    def by_supplier() -> RealDictCursor:
+        query = """
+            SELECT supplier_id, company_name, items, revenue::float8 AS revenue
+            FROM supplier_sales
+              JOIN suppliers USING (supplier_id)
+            ORDER BY revenue DESC
+        """
+        return PgAPI.execute_rdict_query(query)
+
+subscribe('users_changed', User.invalidate)
+subscribe('ref_data_changed', ReferenceData.expire_versions)
@@ -0,0 +1,84 @@
+import os
+import select
+import threading
+import time
+import psycopg2
+from flask import current_app
+
+# channel -> callbacks; a callback receives the notification payload,
+# or None after (re)connecting, when anything may have been missed
+handlers = {}
+
+_listener_lock = threading.Lock()
+
+def subscribe(channel: str, callback) -> None:
+    handlers.setdefault(channel, []).append(callback)
+
+class NotificationListener:
+    def __init__(self, dsn: dict, logger, poll_timeout: float = 5.0):
+        self.dsn = dsn
+        self.logger = logger
+        self.poll_timeout = poll_timeout
+        self.pid = os.getpid()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='pg-listener', daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _dispatch(self, channel: str, payload) -> None:
+        for callback in handlers.get(channel, []):
+            try:
+                callback(payload)
+            except Exception:
+                self.logger.exception('Notification handler for %s failed', channel)
+
+    def _listen(self) -> None:
+        connection = psycopg2.connect(**self.dsn)
+        connection.autocommit = True
+        try:
+            cursor = connection.cursor()
+            for channel in handlers:
+                cursor.execute(f'LISTEN "{channel}"')
+            for channel in handlers:
+                self._dispatch(channel, None)
+
+            while not self._stop.is_set():
+                ready, _, _ = select.select([connection], [], [], self.poll_timeout)
+                if not ready: continue
+                connection.poll()
+                while connection.notifies:
+                    notify = connection.notifies.pop(0)
+                    self._dispatch(notify.channel, notify.payload)
+        finally:
+            connection.close()
+
+    def _run(self) -> None:
+        delay = 1
+        while not self._stop.is_set():
+            try:
+                self._listen()
+            except Exception:
+                self.logger.exception('Notification listener disconnected')
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+            else:
+                delay = 1
+
+def ensure_listener() -> None:
+    listener = current_app.extensions.get('db_listener')
+    if listener is not None and listener.pid == os.getpid(): return
+    with _listener_lock:
+        listener = current_app.extensions.get('db_listener')
+        if listener is None or listener.pid != os.getpid():
+            listener = NotificationListener(current_app.config['DATABASE'], current_app.logger)
+            listener.start()
+            current_app.extensions['db_listener'] = listener
+
+def init_app(app) -> None:
+    # started lazily so that every forked worker runs its own thread
+    if app.config.get('DB_LISTEN'):
+        app.before_request(ensure_listener)
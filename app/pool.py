@@ -0,0 +1,147 @@
+import os
+import threading
+import time
+import psycopg2
+from psycopg2 import extensions
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, dsn: dict, min_size: int = 1, max_size: int = 10,
+                 timeout: float = 5.0, check: bool = True, cursor_factory=None):
+        self.dsn = dsn
+        self.cursor_factory = cursor_factory
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size, 1)
+        self.timeout = timeout
+        self.check = check
+        # a forked worker must not reuse the parent's sockets
+        self.pid = os.getpid()
+
+        self._cond = threading.Condition()
+        self._idle = []
+        self._size = 0
+        self._in_use = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._timeouts = 0
+        self._discarded = 0
+
+        for _ in range(min_size):
+            self._idle.append(self._connect())
+            self._size += 1
+
+    def _connect(self):
+        connection = psycopg2.connect(**self.dsn)
+        connection.autocommit = True
+        if self.cursor_factory is not None:
+            connection.cursor_factory = self.cursor_factory
+        return connection
+
+    @staticmethod
+    def _is_healthy(connection) -> bool:
+        if connection.closed: return False
+        try:
+            # a plain cursor, health checks are not application queries
+            connection.cursor(cursor_factory=extensions.cursor).execute('SELECT 1')
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        waited = False
+        with self._cond:
+            while True:
+                if self._idle:
+                    connection = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    connection = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(
+                        f'No database connection available in {self.timeout}s '
+                        f'(max_size={self.max_size})'
+                    )
+                waited = True
+                self._cond.wait(remaining)
+            self._in_use += 1
+            self._checkouts += 1
+            if waited:
+                self._waits += 1
+                self._wait_time += time.monotonic() - start
+
+        try:
+            if connection is None:
+                connection = self._connect()
+            elif self.check and not self._is_healthy(connection):
+                self._discard(connection)
+                connection = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return connection
+
+    def _discard(self, connection) -> None:
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._discarded += 1
+
+    def putconn(self, connection) -> None:
+        reusable = not connection.closed
+        if reusable:
+            try:
+                status = connection.info.transaction_status
+                if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                    reusable = False
+                elif status != extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+                if reusable and not connection.autocommit:
+                    connection.autocommit = True
+            except psycopg2.Error:
+                reusable = False
+
+        if not reusable: self._discard(connection)
+        with self._cond:
+            self._in_use -= 1
+            if reusable: self._idle.append(connection)
+            else: self._size -= 1
+            self._cond.notify()
+
+    def close(self) -> None:
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for connection in idle:
+            connection.close()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'pid': self.pid,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'wait_time': round(self._wait_time, 6),
+                'timeouts': self._timeouts,
+                'discarded': self._discarded,
+            }
@@ -0,0 +1,65 @@
+import datetime
+from decimal import Decimal
+from typing import NamedTuple
+
+# Typed rows of the hot queries. A NamedTuple row is a plain tuple: no dict
+# per row like RealDictCursor, no shared index lookup like DictCursor, and
+# attribute access (also from templates) runs in C. Queries select exactly
+# the fields of their row type through columns(), so a row never carries
+# columns nobody reads and the projection cannot drift from the type.
+
+def columns(row: type, **expressions: str) -> str:
+    # expressions replace a plain column, e.g. unit_price='unit_price::float8'
+    return ', '.join(
+        f'{expressions[field]} AS {field}' if field in expressions else field
+        for field in row._fields
+    )
+
+class ProductRef(NamedTuple):
+    product_id: int
+    sku: str
+    version: int
+    pictures_directory: str
+
+# the product form and JSON; cached per id by Product.get_many
+class ProductData(NamedTuple):
+    product_id: int
+    category_id: int
+    supplier_id: int
+    product_name: str
+    sku: str
+    description: str
+    unit_price: float
+    discount: float
+    units_in_stock: int
+    version: int
+
+# a row of the product lists, the columns of v_products_all
+class ProductListRow(NamedTuple):
+    product_id: int
+    product_name: str
+    sku: str
+    description: str
+    category_name: str
+    supplier_name: str
+    unit_price: Decimal
+    discount: float
+    units_in_stock: int
+
+# the logged-in user kept in g.current_user, without the password
+class CurrentUser(NamedTuple):
+    user_id: int
+    customer_id: int
+    email: str
+    is_admin: bool
+
+# a row of the user list, the columns of v_users_all
+class UserListRow(NamedTuple):
+    user_id: int
+    first_name: str
+    last_name: str
+    email: str
+    phone: str
+    birth_date: datetime.date
+    entered_date: datetime.date
+    is_admin: bool
@@ -24,6 +24,7 @@ CREATE TABLE products (
 		discount real DEFAULT 0,
 		units_in_stock int DEFAULT 0,
 		rating real DEFAULT 0,
+		version int NOT NULL DEFAULT 1,
 		pictures_directory varchar(255)
 );
 
@@ -82,6 +83,154 @@ CREATE TABLE order_details (
 		discount real DEFAULT 0
 );
 
+-- stock taken from products for a checkout; returned to stock when the
+-- reservation is released or expires, turned into an order when confirmed
+CREATE TABLE reservations (
+		reservation_id serial PRIMARY KEY,
+		customer_id int REFERENCES customers (customer_id),
+		order_id int REFERENCES orders (order_id),
+		created_at timestamp with time zone DEFAULT now(),
+		expires_at timestamp with time zone NOT NULL
+);
+
+CREATE TABLE reservation_lines (
+		reservation_id int REFERENCES reservations (reservation_id) ON DELETE CASCADE,
+		product_id int REFERENCES products (product_id),
+		quantity int NOT NULL CHECK (quantity > 0),
+		PRIMARY KEY (reservation_id, product_id)
+);
+
+-- processed images of a product, written by the image pipeline
+CREATE TABLE product_images (
+		product_id int REFERENCES products (product_id) ON DELETE CASCADE,
+		position int NOT NULL,
+		image_hash char(64) NOT NULL,
+		image_path varchar(255) NOT NULL,
+		width int NOT NULL,
+		height int NOT NULL,
+		thumb_path varchar(255) NOT NULL,
+		thumb_width int NOT NULL,
+		thumb_height int NOT NULL,
+		updated_at timestamp with time zone DEFAULT now(),
+		PRIMARY KEY (product_id, position)
+);
+
+-- versions of rarely changing lookup tables cached by the application
+CREATE TABLE ref_versions (
+		table_name name PRIMARY KEY,
+		version bigint NOT NULL DEFAULT 0,
+		updated_at timestamp with time zone DEFAULT now()
+);
+
+-- version of the stock of all products, kept apart from the catalog version
+-- so checkouts do not flush the pages that show no stock. Every backend bumps
+-- its own slot, so concurrent checkouts rarely queue on the same row; the
+-- version is the sum of all slots
+CREATE TABLE stock_versions (
+		slot smallint PRIMARY KEY,
+		version bigint NOT NULL DEFAULT 0,
+		updated_at timestamp with time zone DEFAULT now()
+);
+
+-- row counts of large tables kept up to date by triggers, so listings
+-- do not have to count(*) on every page view
+CREATE TABLE row_counts (
+		table_name name PRIMARY KEY,
+		row_count bigint NOT NULL DEFAULT 0
+);
+
+INSERT INTO row_counts (table_name, row_count) VALUES ('users', 0);
+
+-- sales aggregates kept up to date by triggers on order_details, orders and
+-- products (see apply_sales_delta); amounts are exact sums of line_amount
+CREATE TABLE order_totals (
+		order_id int PRIMARY KEY REFERENCES orders (order_id) ON DELETE CASCADE,
+		customer_id int,
+		lines int NOT NULL DEFAULT 0,
+		items bigint NOT NULL DEFAULT 0,
+		total numeric NOT NULL DEFAULT 0
+);
+
+CREATE TABLE customer_spend (
+		customer_id int PRIMARY KEY REFERENCES customers (customer_id) ON DELETE CASCADE,
+		orders int NOT NULL DEFAULT 0,
+		items bigint NOT NULL DEFAULT 0,
+		total numeric NOT NULL DEFAULT 0
+);
+
+CREATE TABLE product_sales (
+		product_id int PRIMARY KEY REFERENCES products (product_id) ON DELETE CASCADE,
+		items bigint NOT NULL DEFAULT 0,
+		revenue numeric NOT NULL DEFAULT 0
+);
+
+CREATE TABLE category_sales (
+		category_id int PRIMARY KEY REFERENCES categories (category_id) ON DELETE CASCADE,
+		items bigint NOT NULL DEFAULT 0,
+		revenue numeric NOT NULL DEFAULT 0
+);
+
+CREATE TABLE supplier_sales (
+		supplier_id int PRIMARY KEY REFERENCES suppliers (supplier_id) ON DELETE CASCADE,
+		items bigint NOT NULL DEFAULT 0,
+		revenue numeric NOT NULL DEFAULT 0
+);
+
+-- one signed change of an order line: lines is +1 for an added line
+-- and -1 for a removed one, items and amount carry the same sign
+CREATE TYPE sales_delta AS (
+	order_id int,
+	customer_id int,
+	product_id int,
+	category_id int,
+	supplier_id int,
+	lines int,
+	items bigint,
+	amount numeric
+);
+
+-- INDEXES
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE OR REPLACE FUNCTION product_document(
+	_product_name varchar(60),
+	_sku varchar(20),
+	_description text
+)
+RETURNS tsvector AS
+$$
+	SELECT setweight(to_tsvector('simple', $1), 'A')
+	    || setweight(to_tsvector('simple', $2), 'A')
+	    || setweight(to_tsvector('simple', coalesce($3, '')), 'C');
+$$ LANGUAGE SQL IMMUTABLE;
+
+CREATE INDEX idx_products_document ON products
+	USING gin (product_document(product_name, sku, description));
+CREATE INDEX idx_products_name_trgm ON products USING gin (product_name gin_trgm_ops);
+CREATE INDEX idx_products_sku_trgm ON products USING gin (sku gin_trgm_ops);
+CREATE INDEX idx_categories_name_trgm ON categories USING gin (category_name gin_trgm_ops);
+CREATE INDEX idx_products_price ON products (unit_price, product_id);
+CREATE INDEX idx_products_name ON products (product_name, product_id);
+CREATE INDEX idx_products_category ON products (category_id, product_id);
+CREATE INDEX idx_products_category_price ON products (category_id, unit_price, product_id);
+CREATE INDEX idx_products_supplier ON products (supplier_id, product_id);
+CREATE INDEX idx_products_in_stock_price ON products (unit_price, product_id)
+	WHERE units_in_stock > 0;
+CREATE INDEX idx_product_properties_product ON product_properties
+	(product_id, property_id) INCLUDE (property_value);
+CREATE INDEX idx_product_properties_value ON product_properties
+	(property_id, property_value, product_id);
+CREATE INDEX idx_users_customer_id ON users (customer_id);
+CREATE INDEX idx_reservations_pending ON reservations (expires_at) WHERE order_id IS NULL;
+CREATE INDEX idx_reservation_lines_product_id ON reservation_lines (product_id);
+CREATE INDEX idx_order_details_order_id ON order_details (order_id);
+CREATE INDEX idx_order_details_product_id ON order_details (product_id);
+CREATE INDEX idx_customer_spend_total ON customer_spend (total DESC);
+CREATE INDEX idx_users_email_trgm ON users USING gin (email gin_trgm_ops);
+CREATE INDEX idx_customers_phone_trgm ON customers USING gin (phone gin_trgm_ops);
+CREATE INDEX idx_customers_name_trgm ON customers
+	USING gin ((first_name || ' ' || last_name) gin_trgm_ops);
+
 -- TRIGGERS
 CREATE OR REPLACE FUNCTION set_entered_date()
 RETURNS trigger AS $$
@@ -105,24 +254,49 @@ $$ LANGUAGE plpgsql;
 CREATE TRIGGER tg_set_pictures_directory BEFORE INSERT
 	ON products FOR EACH ROW EXECUTE PROCEDURE set_pictures_directory();
 
+-- every change of a product, stock moves included, makes a new version, so
+-- update_product can refuse to overwrite what its form did not show
+CREATE OR REPLACE FUNCTION bump_product_version()
+RETURNS trigger AS $$
+BEGIN
+	NEW.version = OLD.version + 1;
+	RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tg_bump_product_version BEFORE UPDATE
+	ON products FOR EACH ROW EXECUTE PROCEDURE bump_product_version();
+
+CREATE OR REPLACE FUNCTION order_discount_tier(_total_price double precision)
+RETURNS double precision AS
+$$
+	SELECT CASE
+		WHEN $1 > 15000 THEN 0.1
+		WHEN $1 > 8000 THEN 0.05
+		WHEN $1 > 4000 THEN 0.03
+		ELSE 0
+	END;
+$$ LANGUAGE SQL IMMUTABLE;
+
 CREATE OR REPLACE FUNCTION set_order_discount()
 RETURNS trigger AS $$
 DECLARE 
     total_price double precision;
     order_discount double precision := 0;
 BEGIN
+	-- create_order inserts lines with their final discount already set; it
+	-- runs as shop_order_writer, a role nobody can log in as or set
+	IF current_user = 'shop_order_writer' THEN
+		RETURN NEW;
+	END IF;
+
     SELECT sum(od.quantity * p.unit_price * (1 - od.discount))
     INTO total_price
     FROM order_details od
 	  JOIN products p USING (product_id)
     WHERE od.order_id = NEW.order_id;
 	
-	SELECT CASE
-		WHEN total_price > 15000 THEN 0.1
-		WHEN total_price > 8000 THEN 0.05
-		WHEN total_price > 4000 THEN 0.03
-		ELSE 0
-	END INTO order_discount;
+	order_discount := order_discount_tier(total_price);
 	
     UPDATE order_details
     SET discount = order_discount
@@ -157,6 +331,346 @@ $$ LANGUAGE plpgsql;
 CREATE TRIGGER tg_archive_deleted_user AFTER DELETE ON
     users FOR EACH ROW EXECUTE PROCEDURE archive_deleted_user();
 
+-- tell application workers to drop cached copies of changed users
+CREATE OR REPLACE FUNCTION notify_user_changed()
+RETURNS trigger AS $$
+BEGIN
+	IF TG_OP <> 'INSERT' THEN
+		PERFORM pg_notify('users_changed', OLD.email);
+	END IF;
+	IF TG_OP <> 'DELETE' THEN
+		PERFORM pg_notify('users_changed', NEW.email);
+	END IF;
+	RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tg_notify_user_changed AFTER INSERT OR UPDATE OR DELETE ON
+    users FOR EACH ROW EXECUTE PROCEDURE notify_user_changed();
+
+-- maintain row_counts; transition tables count a whole statement at once
+CREATE OR REPLACE FUNCTION count_rows()
+RETURNS trigger AS $$
+DECLARE
+	delta bigint;
+BEGIN
+	IF TG_OP = 'TRUNCATE' THEN
+		UPDATE row_counts SET row_count = 0 WHERE table_name = TG_TABLE_NAME;
+		RETURN NULL;
+	ELSIF TG_OP = 'INSERT' THEN
+		SELECT count(*) INTO delta FROM new_rows;
+	ELSE
+		SELECT -count(*) INTO delta FROM old_rows;
+	END IF;
+
+	IF delta <> 0 THEN
+		INSERT INTO row_counts (table_name, row_count)
+		VALUES (TG_TABLE_NAME, delta)
+		ON CONFLICT (table_name) DO UPDATE SET
+			row_count = row_counts.row_count + EXCLUDED.row_count;
+	END IF;
+	RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tg_count_rows_insert AFTER INSERT ON users
+	REFERENCING NEW TABLE AS new_rows
+	FOR EACH STATEMENT EXECUTE PROCEDURE count_rows();
+CREATE TRIGGER tg_count_rows_delete AFTER DELETE ON users
+	REFERENCING OLD TABLE AS old_rows
+	FOR EACH STATEMENT EXECUTE PROCEDURE count_rows();
+CREATE TRIGGER tg_count_rows_truncate AFTER TRUNCATE ON
+    users FOR EACH STATEMENT EXECUTE PROCEDURE count_rows();
+
+-- value of an order line, as get_total_customer_costs used to sum it
+CREATE OR REPLACE FUNCTION line_amount(_quantity int, _unit_price numeric, _discount real)
+RETURNS numeric AS
+$$
+	SELECT ($1 * $2 * (1 - $3))::numeric;
+$$ LANGUAGE SQL IMMUTABLE;
+
+-- adds signed line changes to every sales aggregate; rows are upserted in
+-- key order so concurrent orders touching the same rows cannot deadlock
+CREATE OR REPLACE FUNCTION apply_sales_delta(_delta sales_delta[])
+RETURNS void AS $$
+BEGIN
+	WITH delta AS (
+		SELECT * FROM unnest(_delta)
+	), changed AS (
+		INSERT INTO order_totals AS t (order_id, customer_id, lines, items, total)
+		SELECT order_id, customer_id, sum(lines), sum(items), sum(amount)
+		FROM delta
+		GROUP BY order_id, customer_id
+		ORDER BY order_id
+		ON CONFLICT (order_id) DO UPDATE SET
+			lines = t.lines + EXCLUDED.lines,
+			items = t.items + EXCLUDED.items,
+			total = t.total + EXCLUDED.total
+		-- an order counts for its customer while it has lines
+		RETURNING t.customer_id, CASE
+			WHEN t.xmax = 0 AND t.lines > 0 THEN 1
+			WHEN t.xmax = 0 THEN 0
+			WHEN t.lines = 0 THEN -1
+			ELSE 0
+		END AS orders
+	), spend AS (
+		SELECT customer_id, 0 AS orders, items, amount FROM delta
+		UNION ALL
+		SELECT customer_id, orders, 0, 0 FROM changed
+	)
+	INSERT INTO customer_spend AS c (customer_id, orders, items, total)
+	SELECT customer_id, sum(orders), sum(items), sum(amount)
+	FROM spend
+	WHERE customer_id IS NOT NULL
+	GROUP BY customer_id
+	ORDER BY customer_id
+	ON CONFLICT (customer_id) DO UPDATE SET
+		orders = c.orders + EXCLUDED.orders,
+		items  = c.items + EXCLUDED.items,
+		total  = c.total + EXCLUDED.total;
+
+	DELETE FROM order_totals
+	WHERE order_id IN (SELECT order_id FROM unnest(_delta))
+	  AND lines = 0;
+
+	INSERT INTO product_sales AS s (product_id, items, revenue)
+	SELECT product_id, sum(items), sum(amount)
+	FROM unnest(_delta)
+	GROUP BY product_id
+	ORDER BY product_id
+	ON CONFLICT (product_id) DO UPDATE SET
+		items   = s.items + EXCLUDED.items,
+		revenue = s.revenue + EXCLUDED.revenue;
+
+	INSERT INTO category_sales AS s (category_id, items, revenue)
+	SELECT category_id, sum(items), sum(amount)
+	FROM unnest(_delta)
+	GROUP BY category_id
+	ORDER BY category_id
+	ON CONFLICT (category_id) DO UPDATE SET
+		items   = s.items + EXCLUDED.items,
+		revenue = s.revenue + EXCLUDED.revenue;
+
+	INSERT INTO supplier_sales AS s (supplier_id, items, revenue)
+	SELECT supplier_id, sum(items), sum(amount)
+	FROM unnest(_delta)
+	GROUP BY supplier_id
+	ORDER BY supplier_id
+	ON CONFLICT (supplier_id) DO UPDATE SET
+		items   = s.items + EXCLUDED.items,
+		revenue = s.revenue + EXCLUDED.revenue;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION track_order_sales()
+RETURNS trigger AS $$
+DECLARE
+	removed sales_delta[];
+	added sales_delta[];
+BEGIN
+	IF TG_OP = 'TRUNCATE' THEN
+		DELETE FROM order_totals;
+		DELETE FROM customer_spend;
+		DELETE FROM product_sales;
+		DELETE FROM category_sales;
+		DELETE FROM supplier_sales;
+		RETURN NULL;
+	END IF;
+
+	IF TG_OP IN ('UPDATE', 'DELETE') THEN
+		SELECT array_agg(ROW(
+			od.order_id, o.customer_id, od.product_id, p.category_id, p.supplier_id,
+			-1, -od.quantity, -line_amount(od.quantity, p.unit_price, od.discount)
+		)::sales_delta)
+		INTO removed
+		FROM old_rows od
+		  JOIN orders o USING (order_id)
+		  JOIN products p USING (product_id);
+	END IF;
+	IF TG_OP IN ('UPDATE', 'INSERT') THEN
+		SELECT array_agg(ROW(
+			od.order_id, o.customer_id, od.product_id, p.category_id, p.supplier_id,
+			1, od.quantity, line_amount(od.quantity, p.unit_price, od.discount)
+		)::sales_delta)
+		INTO added
+		FROM new_rows od
+		  JOIN orders o USING (order_id)
+		  JOIN products p USING (product_id);
+	END IF;
+
+	IF removed IS NOT NULL OR added IS NOT NULL THEN
+		PERFORM apply_sales_delta(coalesce(removed, '{}') || coalesce(added, '{}'));
+	END IF;
+	RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tg_track_order_sales_insert AFTER INSERT ON order_details
+	REFERENCING NEW TABLE AS new_rows
+	FOR EACH STATEMENT EXECUTE PROCEDURE track_order_sales();
+CREATE TRIGGER tg_track_order_sales_update AFTER UPDATE ON order_details
+	REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+	FOR EACH STATEMENT EXECUTE PROCEDURE track_order_sales();
+CREATE TRIGGER tg_track_order_sales_delete AFTER DELETE ON order_details
+	REFERENCING OLD TABLE AS old_rows
+	FOR EACH STATEMENT EXECUTE PROCEDURE track_order_sales();
+CREATE TRIGGER tg_track_order_sales_truncate AFTER TRUNCATE ON
+    order_details FOR EACH STATEMENT EXECUTE PROCEDURE track_order_sales();
+
+-- a new price, category or supplier revalues every line already sold
+CREATE OR REPLACE FUNCTION track_product_sales()
+RETURNS trigger AS $$
+DECLARE
+	delta sales_delta[];
+BEGIN
+	WITH changed AS (
+		SELECT o.product_id,
+		       o.unit_price AS old_price, o.category_id AS old_category, o.supplier_id AS old_supplier,
+		       n.unit_price AS new_price, n.category_id AS new_category, n.supplier_id AS new_supplier
+		FROM old_rows o
+		  JOIN new_rows n USING (product_id)
+		WHERE (o.unit_price, o.category_id, o.supplier_id)
+		      IS DISTINCT FROM (n.unit_price, n.category_id, n.supplier_id)
+	)
+	SELECT array_agg(d)
+	INTO delta
+	FROM changed c
+	  JOIN order_details od USING (product_id)
+	  JOIN orders ord USING (order_id)
+	  CROSS JOIN LATERAL (VALUES
+		(ROW(od.order_id, ord.customer_id, c.product_id, c.old_category, c.old_supplier,
+		     -1, -od.quantity, -line_amount(od.quantity, c.old_price, od.discount))::sales_delta),
+		(ROW(od.order_id, ord.customer_id, c.product_id, c.new_category, c.new_supplier,
+		     1, od.quantity, line_amount(od.quantity, c.new_price, od.discount))::sales_delta)
+	  ) AS v (d);
+
+	IF delta IS NOT NULL THEN
+		PERFORM apply_sales_delta(delta);
+	END IF;
+	RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tg_track_product_sales AFTER UPDATE ON products
+	REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+	FOR EACH STATEMENT EXECUTE PROCEDURE track_product_sales();
+
+-- moving an order to another customer moves its total along
+CREATE OR REPLACE FUNCTION track_order_customer()
+RETURNS trigger AS $$
+BEGIN
+	WITH moved AS (
+		UPDATE order_totals t
+		SET customer_id = n.customer_id
+		FROM old_rows o
+		  JOIN new_rows n USING (order_id)
+		WHERE t.order_id = o.order_id
+		  AND o.customer_id IS DISTINCT FROM n.customer_id
+		RETURNING o.customer_id AS old_customer, n.customer_id AS new_customer, t.items, t.total
+	), spend AS (
+		SELECT old_customer AS customer_id, -1 AS orders, -items AS items, -total AS total FROM moved
+		UNION ALL
+		SELECT new_customer, 1, items, total FROM moved
+	)
+	INSERT INTO customer_spend AS c (customer_id, orders, items, total)
+	SELECT customer_id, sum(orders), sum(items), sum(total)
+	FROM spend
+	WHERE customer_id IS NOT NULL
+	GROUP BY customer_id
+	ORDER BY customer_id
+	ON CONFLICT (customer_id) DO UPDATE SET
+		orders = c.orders + EXCLUDED.orders,
+		items  = c.items + EXCLUDED.items,
+		total  = c.total + EXCLUDED.total;
+	RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tg_track_order_customer AFTER UPDATE ON orders
+	REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+	FOR EACH STATEMENT EXECUTE PROCEDURE track_order_customer();
+
+-- bump the cached version of a lookup table on any change of it
+CREATE OR REPLACE FUNCTION bump_ref_version()
+RETURNS trigger AS $$
+BEGIN
+	INSERT INTO ref_versions (table_name, version)
+	VALUES (TG_TABLE_NAME, 1)
+	ON CONFLICT (table_name) DO UPDATE SET
+		version    = ref_versions.version + 1,
+		updated_at = now();
+	PERFORM pg_notify('ref_data_changed', TG_TABLE_NAME);
+	RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tg_bump_ref_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON
+    categories FOR EACH STATEMENT EXECUTE PROCEDURE bump_ref_version();
+CREATE TRIGGER tg_bump_ref_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON
+    suppliers FOR EACH STATEMENT EXECUTE PROCEDURE bump_ref_version();
+CREATE TRIGGER tg_bump_ref_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON
+    properties FOR EACH STATEMENT EXECUTE PROCEDURE bump_ref_version();
+CREATE TRIGGER tg_bump_ref_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON
+    category_properties FOR EACH STATEMENT EXECUTE PROCEDURE bump_ref_version();
+-- versions of the user list, keying its cached page fragments
+CREATE TRIGGER tg_bump_ref_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON
+    users FOR EACH STATEMENT EXECUTE PROCEDURE bump_ref_version();
+CREATE TRIGGER tg_bump_ref_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON
+    customers FOR EACH STATEMENT EXECUTE PROCEDURE bump_ref_version();
+
+-- one version for everything a catalog page shows; HTTP validators of
+-- product pages and manifests are derived from it
+CREATE OR REPLACE FUNCTION bump_catalog_version()
+RETURNS trigger AS $$
+BEGIN
+	INSERT INTO ref_versions (table_name, version)
+	VALUES ('catalog', 1)
+	ON CONFLICT (table_name) DO UPDATE SET
+		version    = ref_versions.version + 1,
+		updated_at = now();
+	RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+-- updates of units_in_stock alone (checkouts, reservations) bump the stock
+-- version instead: they would otherwise all queue on the one 'catalog' row
+-- and flush every cached page. version is set by tg_bump_product_version
+-- and never named in SET, so it follows whichever of the two is bumped
+CREATE TRIGGER tg_bump_catalog_version AFTER INSERT OR DELETE OR TRUNCATE ON
+    products FOR EACH STATEMENT EXECUTE PROCEDURE bump_catalog_version();
+CREATE TRIGGER tg_bump_catalog_version_update AFTER UPDATE OF
+    product_id, category_id, supplier_id, product_name, sku, description,
+    unit_price, discount, rating, pictures_directory
+    ON products FOR EACH STATEMENT EXECUTE PROCEDURE bump_catalog_version();
+
+CREATE OR REPLACE FUNCTION bump_stock_version()
+RETURNS trigger AS $$
+BEGIN
+	INSERT INTO stock_versions (slot, version)
+	VALUES (pg_backend_pid() % 16, 1)
+	ON CONFLICT (slot) DO UPDATE SET
+		version    = stock_versions.version + 1,
+		updated_at = now();
+	RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tg_bump_stock_version AFTER UPDATE OF units_in_stock
+    ON products FOR EACH STATEMENT EXECUTE PROCEDURE bump_stock_version();
+CREATE TRIGGER tg_bump_catalog_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON
+    categories FOR EACH STATEMENT EXECUTE PROCEDURE bump_catalog_version();
+CREATE TRIGGER tg_bump_catalog_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON
+    suppliers FOR EACH STATEMENT EXECUTE PROCEDURE bump_catalog_version();
+CREATE TRIGGER tg_bump_catalog_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON
+    product_images FOR EACH STATEMENT EXECUTE PROCEDURE bump_catalog_version();
+CREATE TRIGGER tg_bump_catalog_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON
+    product_properties FOR EACH STATEMENT EXECUTE PROCEDURE bump_catalog_version();
+-- property names and the properties a category shows are on product pages too
+CREATE TRIGGER tg_bump_catalog_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON
+    properties FOR EACH STATEMENT EXECUTE PROCEDURE bump_catalog_version();
+CREATE TRIGGER tg_bump_catalog_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON
+    category_properties FOR EACH STATEMENT EXECUTE PROCEDURE bump_catalog_version();
+
 -- VIEWS
 CREATE OR REPLACE VIEW v_suppliers_names_all AS
 	SELECT supplier_id, company_name
@@ -185,6 +699,37 @@ CREATE OR REPLACE VIEW v_products_all AS
 	  JOIN categories USING (category_id)
 	  JOIN suppliers USING (supplier_id);
 
+-- v_products_all with the keys the catalog filter narrows by
+CREATE OR REPLACE VIEW v_products_filter AS
+	SELECT product_id,
+		   product_name,
+		   sku,
+		   description,
+		   category_id,
+		   category_name,
+		   supplier_id,
+		   concat(
+			   company_name, '(',
+			   contact_name, ', ',
+			   phone, ', ',
+			   email, ')'
+		   ) AS supplier_name,
+		   unit_price,
+		   discount,
+		   units_in_stock
+	FROM products
+	  JOIN categories USING (category_id)
+	  JOIN suppliers USING (supplier_id);
+
+CREATE OR REPLACE VIEW v_users_all AS
+	SELECT user_id,
+		   first_name, last_name,
+		   email, phone,
+		   birth_date, entered_date,
+		   is_admin
+	FROM users LEFT JOIN
+	  customers USING (customer_id);
+
 CREATE OR REPLACE VIEW get_all_created_users AS
 	SELECT *
 	FROM users
@@ -220,6 +765,107 @@ DECLARE _customer_id int;
     END;
 $$;
 
+-- recomputes the sales aggregates from order_details, e.g. after a bulk load
+-- with triggers disabled; blocks order and price changes while it runs
+CREATE OR REPLACE PROCEDURE rebuild_sales_aggregates()
+LANGUAGE plpgsql
+AS $$
+BEGIN
+	LOCK TABLE order_details, orders, products IN SHARE MODE;
+	DELETE FROM order_totals;
+	DELETE FROM customer_spend;
+	DELETE FROM product_sales;
+	DELETE FROM category_sales;
+	DELETE FROM supplier_sales;
+
+	CREATE TEMP TABLE sales_lines ON COMMIT DROP AS
+		SELECT od.order_id, o.customer_id, od.product_id, p.category_id, p.supplier_id,
+		       od.quantity, line_amount(od.quantity, p.unit_price, od.discount) AS amount
+		FROM order_details od
+		  JOIN orders o USING (order_id)
+		  JOIN products p USING (product_id);
+
+	INSERT INTO order_totals (order_id, customer_id, lines, items, total)
+	SELECT order_id, customer_id, count(*), sum(quantity), sum(amount)
+	FROM sales_lines
+	GROUP BY order_id, customer_id;
+
+	INSERT INTO customer_spend (customer_id, orders, items, total)
+	SELECT customer_id, count(*), sum(items), sum(total)
+	FROM order_totals
+	WHERE customer_id IS NOT NULL
+	GROUP BY customer_id;
+
+	INSERT INTO product_sales (product_id, items, revenue)
+	SELECT product_id, sum(quantity), sum(amount)
+	FROM sales_lines
+	GROUP BY product_id;
+
+	INSERT INTO category_sales (category_id, items, revenue)
+	SELECT category_id, sum(quantity), sum(amount)
+	FROM sales_lines
+	GROUP BY category_id;
+
+	INSERT INTO supplier_sales (supplier_id, items, revenue)
+	SELECT supplier_id, sum(quantity), sum(amount)
+	FROM sales_lines
+	GROUP BY supplier_id;
+
+	DROP TABLE sales_lines;
+END;
+$$;
+
+-- inserts an order with all of its lines at once. The discount is what
+-- tg_set_order_discount would leave after inserting the lines one by one:
+-- each line tiers the sum of the lines before it at the previous discount.
+-- Running sums for every tier make that one pass instead of a re-sum per line.
+CREATE OR REPLACE PROCEDURE create_order(
+	_customer_id int,
+	_product_ids int[],
+	_quantities int[],
+	INOUT _order_id int DEFAULT NULL
+)
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public, pg_temp
+AS $$
+DECLARE
+	tiers double precision[] := ARRAY[0, 0.03, 0.05, 0.1];
+	totals double precision[] := ARRAY[0, 0, 0, 0];
+	tier int := 1;
+	order_discount double precision := 0;
+	line record;
+BEGIN
+	IF cardinality(_product_ids) IS DISTINCT FROM cardinality(_quantities) THEN
+		RAISE EXCEPTION 'create_order: % products but % quantities',
+			cardinality(_product_ids), cardinality(_quantities);
+	END IF;
+
+	INSERT INTO orders (customer_id, created_at)
+	VALUES (_customer_id, now())
+	RETURNING order_id INTO _order_id;
+
+	FOR line IN
+		SELECT l.quantity, p.unit_price
+		FROM unnest(_product_ids, _quantities) WITH ORDINALITY AS l (product_id, quantity, position)
+		  JOIN products p USING (product_id)
+		ORDER BY l.position
+	LOOP
+		order_discount := order_discount_tier(totals[tier]);
+		tier := array_position(tiers, order_discount);
+		FOR i IN 1..4 LOOP
+			-- the same expression the trigger sums over stored (real) discounts
+			totals[i] := totals[i] + line.quantity * line.unit_price * (1 - tiers[i]::real);
+		END LOOP;
+	END LOOP;
+
+	INSERT INTO order_details (order_id, product_id, quantity, discount)
+	SELECT _order_id, l.product_id, l.quantity, order_discount
+	FROM unnest(_product_ids, _quantities) WITH ORDINALITY AS l (product_id, quantity, position)
+	ORDER BY l.position;
+END;
+$$;
+
 CREATE OR REPLACE PROCEDURE create_product(
 	_supplier_id int,
 	_category_id int,
@@ -239,6 +885,9 @@ AS $$
 	VALUES ($1, $2, $3, $4, $5, $6, $7, $8);
 $$ LANGUAGE SQL;
 
+-- _version is the version the form was filled from; a product changed since
+-- then (by another admin, a reservation or a bulk edit) is left untouched.
+-- Without a version the update is unconditional, as before versions existed
 CREATE OR REPLACE PROCEDURE update_product(
 	_product_id int,
 	_supplier_id int,
@@ -248,20 +897,132 @@ CREATE OR REPLACE PROCEDURE update_product(
 	_unit_price numeric(15, 6),
 	_discount real,
 	_units_in_stock int,
-	_description text
+	_description text,
+	_version int
 )
+LANGUAGE plpgsql
 AS $$
+BEGIN
 	UPDATE products SET
-		supplier_id    = $2,
-		category_id    = $3,
-		product_name   = $4,
-		sku            = $5,
-		unit_price     = $6,
-		discount       = $7,
-		units_in_stock = $8,
-		description    = $9
-	WHERE product_id = _product_id;
-$$ LANGUAGE SQL;
+		supplier_id    = _supplier_id,
+		category_id    = _category_id,
+		product_name   = _product_name,
+		sku            = _sku,
+		unit_price     = _unit_price,
+		discount       = _discount,
+		units_in_stock = _units_in_stock,
+		description    = _description
+	WHERE product_id = _product_id
+	  AND (_version IS NULL OR version = _version);
+
+	IF NOT FOUND AND _version IS NOT NULL THEN
+		RAISE EXCEPTION 'product % was changed after version %', _product_id, _version
+			USING ERRCODE = 'serialization_failure';
+	END IF;
+END;
+$$;
+
+-- takes the stock of all lines or of none. Rows are locked in product_id
+-- order, so concurrent reservations of overlapping products queue up
+-- instead of deadlocking; a short line raises check_violation
+CREATE OR REPLACE PROCEDURE reserve_stock(
+	_customer_id int,
+	_product_ids int[],
+	_quantities int[],
+	_ttl interval,
+	INOUT _reservation_id int DEFAULT NULL
+)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+	ids int[];
+	quantities int[];
+	taken int;
+BEGIN
+	IF cardinality(_product_ids) IS DISTINCT FROM cardinality(_quantities) THEN
+		RAISE EXCEPTION 'reserve_stock: % products but % quantities',
+			cardinality(_product_ids), cardinality(_quantities);
+	END IF;
+	IF 0 >= ANY(_quantities) THEN
+		RAISE EXCEPTION 'reserve_stock: quantities have to be positive'
+			USING ERRCODE = 'invalid_parameter_value';
+	END IF;
+
+	SELECT array_agg(product_id ORDER BY product_id),
+	       array_agg(quantity ORDER BY product_id)
+	INTO ids, quantities
+	FROM (
+		SELECT product_id, sum(quantity)::int AS quantity
+		FROM unnest(_product_ids, _quantities) AS l (product_id, quantity)
+		GROUP BY product_id
+	) l;
+
+	-- NO KEY UPDATE, like the UPDATE below, still lets orders reference them
+	PERFORM 1 FROM products
+	WHERE product_id = ANY(ids)
+	ORDER BY product_id
+	FOR NO KEY UPDATE;
+
+	WITH taken_rows AS (
+		UPDATE products p
+		SET units_in_stock = p.units_in_stock - l.quantity
+		FROM unnest(ids, quantities) AS l (product_id, quantity)
+		WHERE p.product_id = l.product_id
+		  AND p.units_in_stock >= l.quantity
+		RETURNING p.product_id
+	)
+	SELECT count(*) INTO taken FROM taken_rows;
+
+	IF taken < cardinality(ids) THEN
+		RAISE EXCEPTION 'not enough stock for % of % products', cardinality(ids) - taken, cardinality(ids)
+			USING ERRCODE = 'check_violation';
+	END IF;
+
+	INSERT INTO reservations (customer_id, expires_at)
+	VALUES (_customer_id, now() + _ttl)
+	RETURNING reservation_id INTO _reservation_id;
+
+	INSERT INTO reservation_lines (reservation_id, product_id, quantity)
+	SELECT _reservation_id, l.product_id, l.quantity
+	FROM unnest(ids, quantities) AS l (product_id, quantity);
+END;
+$$;
+
+-- turns a pending reservation into an order; the stock is already taken
+CREATE OR REPLACE PROCEDURE confirm_reservation(
+	_reservation_id int,
+	INOUT _order_id int DEFAULT NULL
+)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+	reservation record;
+	ids int[];
+	quantities int[];
+BEGIN
+	SELECT * INTO reservation
+	FROM reservations
+	WHERE reservation_id = _reservation_id
+	  AND order_id IS NULL
+	  AND expires_at > now()
+	FOR UPDATE;
+
+	IF NOT FOUND THEN
+		RAISE EXCEPTION 'reservation % is confirmed, released or expired', _reservation_id
+			USING ERRCODE = 'no_data_found';
+	END IF;
+
+	SELECT array_agg(product_id ORDER BY product_id),
+	       array_agg(quantity ORDER BY product_id)
+	INTO ids, quantities
+	FROM reservation_lines
+	WHERE reservation_id = _reservation_id;
+
+	CALL create_order(reservation.customer_id, ids, quantities, _order_id);
+	UPDATE reservations SET order_id = _order_id
+	WHERE reservation_id = _reservation_id;
+END;
+$$;
 
 -- table functions
 CREATE OR REPLACE FUNCTION get_paginated_users(_limit int, _offset int)
@@ -299,52 +1060,199 @@ RETURNS TABLE (
 	FROM products
 	  JOIN product_properties USING (product_id)
 	  JOIN properties USING (property_id)
-$$ LANGUAGE SQL;
+	WHERE product_id = _product_id
+	ORDER BY property_name
+$$ LANGUAGE SQL STABLE;
 
-CREATE OR REPLACE FUNCTION get_products_by_price(numeric(15, 6), numeric(15, 6))
-RETURNS TABLE (LIKE v_products_all)
+-- property values of many products at once, with the category of each
+-- product (also of those without values); names come from the cached
+-- category_properties and properties
+CREATE OR REPLACE FUNCTION get_properties_for_products(_product_ids int[])
+RETURNS TABLE (
+	product_id int,
+	category_id int,
+	property_id int,
+	property_value varchar(40)
+) AS $$
+	SELECT p.product_id,
+	       p.category_id,
+	       pp.property_id,
+	       pp.property_value
+	FROM products p
+	  LEFT JOIN product_properties pp USING (product_id)
+	WHERE p.product_id = ANY(_product_ids)
+	ORDER BY p.product_id, pp.property_id
+$$ LANGUAGE SQL STABLE;
+
+-- keyset pagination: seek past _after_id, then skip _offset rows
+CREATE OR REPLACE FUNCTION get_users_page(_after_id int, _offset int, _limit int)
+RETURNS TABLE (LIKE v_users_all)
 AS $$
-	SELECT * FROM v_products_all
-	WHERE unit_price BETWEEN $1 AND $2;
+	SELECT * FROM v_users_all
+	WHERE user_id > $1
+	ORDER BY user_id
+	OFFSET $2
+	LIMIT $3;
 $$ LANGUAGE SQL;
 
-CREATE OR REPLACE FUNCTION get_products_by_category(varchar(40))
-RETURNS TABLE (LIKE v_products_all)
+-- ids of users whose email, phone or full name contain the query
+CREATE OR REPLACE FUNCTION find_users(_query varchar(255))
+RETURNS SETOF int AS
+$$
+	SELECT user_id FROM users
+	WHERE email ILIKE concat('%', $1, '%')
+	UNION
+	SELECT u.user_id
+	FROM customers c
+	  JOIN users u USING (customer_id)
+	WHERE c.phone ILIKE concat('%', $1, '%')
+	   OR (c.first_name || ' ' || c.last_name) ILIKE concat('%', $1, '%');
+$$ LANGUAGE SQL STABLE;
+
+CREATE OR REPLACE FUNCTION get_users_matching_page(
+	varchar(255), _after_id int, _offset int, _limit int
+)
+RETURNS TABLE (LIKE v_users_all)
 AS $$
-	SELECT * FROM v_products_all
-	WHERE category_name ILIKE concat($1, '%');
-$$ LANGUAGE SQL;
+	SELECT * FROM v_users_all
+	WHERE user_id IN (SELECT find_users($1))
+	  AND user_id > $2
+	ORDER BY user_id
+	OFFSET $3
+	LIMIT $4;
+$$ LANGUAGE SQL STABLE;
+
+-- the trigger-maintained counter unless an exact count is asked for
+CREATE OR REPLACE FUNCTION count_users(_exact boolean DEFAULT false)
+RETURNS bigint AS
+$$
+	SELECT CASE
+		WHEN $1 THEN (SELECT count(*) FROM users)
+		ELSE (SELECT row_count FROM row_counts WHERE table_name = 'users')
+	END;
+$$ LANGUAGE SQL STABLE;
+
+CREATE OR REPLACE FUNCTION count_users_matching(varchar(255))
+RETURNS bigint AS
+$$
+	SELECT count(*) FROM find_users($1);
+$$ LANGUAGE SQL STABLE;
 
-CREATE OR REPLACE FUNCTION get_products_by_name(varchar(40))
+-- ranked search over name, SKU, description and category, best matches first
+CREATE OR REPLACE FUNCTION search_products(_query varchar(100), _limit int)
 RETURNS TABLE (LIKE v_products_all)
 AS $$
-	SELECT * FROM v_products_all
-	WHERE product_name ILIKE concat($1, '%');
+	WITH candidates AS (
+		SELECT product_id
+		FROM products
+		WHERE product_document(product_name, sku, description)
+		      @@ websearch_to_tsquery('simple', $1)
+		UNION
+		SELECT product_id
+		FROM products
+		WHERE $1 <% product_name
+		   OR sku ILIKE concat($1, '%')
+		UNION
+		SELECT product_id
+		FROM products
+		WHERE category_id IN (
+			SELECT category_id FROM categories
+			WHERE $1 <% category_name
+		)
+	), ranked AS (
+		SELECT p.product_id,
+		       ts_rank(
+			       product_document(p.product_name, p.sku, p.description),
+			       websearch_to_tsquery('simple', $1)
+		       )
+		       + word_similarity($1, p.product_name)
+		       + word_similarity($1, p.sku)
+		       + word_similarity($1, c.category_name) / 2 AS rank
+		FROM candidates
+		  JOIN products p USING (product_id)
+		  JOIN categories c USING (category_id)
+		ORDER BY rank DESC, p.product_id
+		LIMIT $2
+	)
+	SELECT v.*
+	FROM ranked r
+	  JOIN v_products_all v USING (product_id)
+	ORDER BY r.rank DESC, r.product_id;
+$$ LANGUAGE SQL STABLE;
+
+-- returns the stock of pending reservations. Like confirm_reservation it
+-- locks the reservations first, then the products in reserve_stock's order
+CREATE OR REPLACE FUNCTION release_reservations(_reservation_ids int[])
+RETURNS int AS $$
+DECLARE
+	released int;
+BEGIN
+	PERFORM 1 FROM reservations
+	WHERE reservation_id = ANY(_reservation_ids)
+	ORDER BY reservation_id
+	FOR UPDATE;
+
+	PERFORM 1 FROM products
+	WHERE product_id IN (
+		SELECT product_id FROM reservation_lines
+		WHERE reservation_id = ANY(_reservation_ids)
+	)
+	ORDER BY product_id
+	FOR NO KEY UPDATE;
+
+	WITH released_rows AS (
+		DELETE FROM reservations
+		WHERE reservation_id = ANY(_reservation_ids)
+		  AND order_id IS NULL
+		RETURNING reservation_id
+	), returned AS (
+		UPDATE products p
+		SET units_in_stock = p.units_in_stock + l.quantity
+		FROM (
+			SELECT product_id, sum(quantity)::int AS quantity
+			FROM reservation_lines
+			WHERE reservation_id IN (SELECT reservation_id FROM released_rows)
+			GROUP BY product_id
+		) l
+		WHERE p.product_id = l.product_id
+	)
+	SELECT count(*) INTO released FROM released_rows;
+	RETURN released;
+END
+$$ LANGUAGE plpgsql;
+
+-- releases at most _limit expired reservations; rows another session is
+-- already expiring are skipped, so several workers can run it at once
+CREATE OR REPLACE FUNCTION expire_reservations(_limit int DEFAULT 1000)
+RETURNS int AS $$
+	SELECT release_reservations(ARRAY(
+		SELECT reservation_id
+		FROM reservations
+		WHERE order_id IS NULL
+		  AND expires_at <= now()
+		ORDER BY expires_at
+		LIMIT _limit
+		FOR UPDATE SKIP LOCKED
+	));
 $$ LANGUAGE SQL;
 
 -- scalar functions
 CREATE OR REPLACE FUNCTION get_total_order_price(_order_id int)
 RETURNS double precision AS
 $$
-	SELECT od.quantity * p.unit_price * (1 - od.discount)
-	FROM order_details od
-	JOIN products p USING (product_id)
+	SELECT total::double precision
+	FROM order_totals
 	WHERE order_id = _order_id;
-$$ LANGUAGE SQL;
+$$ LANGUAGE SQL STABLE;
 
 CREATE OR REPLACE FUNCTION get_total_customer_costs(_customer_id int)
 RETURNS double precision AS
 $$
-	SELECT COALESCE(sum(od.quantity * p.unit_price * (1 - od.discount)), 0)
-	FROM order_details od
-	JOIN products p USING (product_id)
-	WHERE EXISTS (
-		SELECT 1
-		FROM orders o
-		WHERE o.customer_id = _customer_id
-		  AND o.order_id = od.order_id
-	);
-$$ LANGUAGE SQL;
+	SELECT COALESCE((
+		SELECT total FROM customer_spend
+		WHERE customer_id = _customer_id
+	), 0)::double precision;
+$$ LANGUAGE SQL STABLE;
 
 -- FILL TABLES
 INSERT INTO users (email, password, is_admin)
@@ -591,3 +1499,8 @@ GRANT SELECT, UPDATE, DELETE, INSERT, TRIGGER ON ALL TABLES IN
 
 GRANT USAGE, SELECT ON ALL SEQUENCES IN SCHEMA public TO shop_manager;
 CREATE USER shop_manager_user WITH PASSWORD 'hard_to_guess' IN ROLE shop_manager;
+
+-- owner of create_order, the only writer tg_set_order_discount trusts with
+-- precomputed discounts; it has the tables through shop_manager
+CREATE ROLE shop_order_writer NOLOGIN IN ROLE shop_manager;
+ALTER PROCEDURE create_order OWNER TO shop_order_writer;
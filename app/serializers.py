@@ -0,0 +1,13 @@
+import datetime
+import json
+from decimal import Decimal
+
+
+def json_default(value):
+    if isinstance(value, Decimal): return float(value)
+    if isinstance(value, (datetime.date, datetime.datetime, datetime.time)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+def dumps(data) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=json_default)
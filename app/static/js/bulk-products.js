@@ -0,0 +1,40 @@
+'use strict';
+
+const bulkUrl = `http://${location.host}/admin/products/bulk`;
+const bulkForm = document.getElementById('bulk-form');
+const bulkReport = bulkForm.querySelector('.bulk-report');
+const selectAll = document.querySelector('input.select-all');
+const productBoxes = document.querySelectorAll('input.select-product');
+
+selectAll.addEventListener('change', () => {
+  for (const box of productBoxes) box.checked = selectAll.checked;
+});
+
+bulkForm.addEventListener('submit', async (event) => {
+  event.preventDefault();
+  const option = bulkForm.elements.operation.selectedOptions[0];
+  const body = {};
+  if (event.submitter.value === 'selected') {
+    body.ids = [...productBoxes].filter(box => box.checked).map(box => Number(box.value));
+    if (!body.ids.length) return;
+  } else {
+    body.filter = location.search.slice(1);
+    if (!confirm('Apply to every product matching the current filter?')) return;
+  }
+  if (option.dataset.field) body[option.dataset.field] = Number(bulkForm.elements.amount.value);
+
+  const response = await fetch(`${bulkUrl}/${option.value}`, {
+    method: 'POST',
+    headers: {'Content-Type': 'application/json'},
+    body: JSON.stringify(body),
+  });
+  if (!response.ok) {
+    bulkReport.textContent = `Failed: ${response.status}`;
+    return;
+  }
+  const report = await response.json();
+  let text = `${report.rows} products in ${report.seconds}s`;
+  if (report.skipped) text += `, ${report.skipped} kept because they were ordered or reserved`;
+  bulkReport.textContent = text;
+  setTimeout(() => location.reload(), 1000);
+});
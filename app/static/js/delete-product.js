@@ -1,15 +1,8 @@
 'use strict';
 
 const baseUrl = `http://${location.host}/admin/products`;
-const paginationLinks = document.querySelectorAll('.pagination a');
 const deleteControls= document.querySelectorAll('span.delete');
 
-for (const link of paginationLinks) {
-  if (link.href === baseUrl) {
-    link.href += '?page=1';
-  }
-}
-
 for (const control of deleteControls) {
   control.addEventListener('click', async () => {
     const primaryKey = control.dataset.pk;
@@ -17,5 +10,7 @@ for (const control of deleteControls) {
       method: 'DELETE',
     });
     if (response.ok) control.closest('tr').remove();
+    // the server flashed why the product was kept
+    else if (response.status === 409) location.reload();
   });
 }
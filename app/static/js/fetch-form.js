@@ -33,7 +33,7 @@ const fetchImages = async () => {
   const { images } = await response.json();
   if (images.length) {
     preview.removeChild(preview.children[0]);
-    images.forEach(addToCarousel);
+    images.forEach((image) => addToCarousel(image.url));
   }
 };
 
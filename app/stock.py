@@ -0,0 +1,92 @@
+import click
+from datetime import timedelta
+from typing import List, Tuple
+from flask import current_app
+from flask.cli import with_appcontext
+from psycopg2 import errors
+from app.db import get_db, mark_write
+from app.models import PgAPI, Product
+
+
+class OutOfStock(Exception):
+    pass
+
+
+class ReservationClosed(Exception):
+    pass
+
+
+# stock only ever moves with conditional updates, so concurrent checkouts
+# cannot sell more than units_in_stock. Every move bumps the stock version
+# (see tg_bump_stock_version), which other workers see on their next catalog
+# check; the rows cached by this process are dropped right away
+
+def take(pk: int, quantity: int) -> int:
+    if quantity <= 0: raise ValueError('quantity has to be positive')
+    query = """
+        UPDATE products SET units_in_stock = units_in_stock - %s
+        WHERE product_id = %s AND units_in_stock >= %s
+        RETURNING units_in_stock
+    """
+    row = PgAPI._execute(get_db(), query, (quantity, pk, quantity)).fetchone()
+    mark_write()
+    if row is None: raise OutOfStock(f'not enough stock of product {pk}')
+    Product.invalidate_rows([pk])
+    return row[0]
+
+# lines are (product_id, quantity); all of them are taken or none, and the
+# stock comes back unless the reservation is confirmed before it expires
+def reserve(customer_id: int, lines: List[Tuple[int, int]], ttl: float = None) -> int:
+    if not lines: raise ValueError('a reservation needs at least one line')
+    if ttl is None: ttl = current_app.config['RESERVATION_TTL']
+    query = 'CALL reserve_stock(%s, %s::int[], %s::int[], %s)'
+    product_ids = [product_id for product_id, _ in lines]
+    quantities = [quantity for _, quantity in lines]
+    try:
+        cursor = PgAPI._execute(get_db(), query, (
+            customer_id, product_ids, quantities, timedelta(seconds=ttl)
+        ))
+    except errors.CheckViolation as e:
+        raise OutOfStock(e.diag.message_primary) from e
+    except errors.InvalidParameterValue as e:
+        raise ValueError(e.diag.message_primary) from e
+    mark_write()
+    Product.invalidate_rows(product_ids)
+    return cursor.fetchone()[0]
+
+def confirm(reservation_id: int) -> int:
+    query = 'CALL confirm_reservation(%s)'
+    try:
+        cursor = PgAPI._execute(get_db(), query, (reservation_id, ))
+    except errors.NoDataFound as e:
+        raise ReservationClosed(e.diag.message_primary) from e
+    mark_write()
+    return cursor.fetchone()[0]
+
+def release(reservation_id: int) -> bool:
+    query = 'SELECT release_reservations(%s::int[])'
+    released = PgAPI._execute(get_db(), query, ([reservation_id], )).fetchone()[0]
+    mark_write()
+    if released: Product.invalidate_rows()
+    return bool(released)
+
+def expire(limit: int = 1000) -> int:
+    query = 'SELECT expire_reservations(%s)'
+    expired = PgAPI._execute(get_db(), query, (limit, )).fetchone()[0]
+    mark_write()
+    if expired: Product.invalidate_rows()
+    return expired
+
+@click.command('expire-reservations')
+@click.option('--limit', type=int, default=1000, help='Reservations released per batch.')
+@with_appcontext
+def expire_reservations_command(limit):
+    total = 0
+    while True:
+        expired = expire(limit)
+        total += expired
+        if expired < limit: break
+    click.echo(f'Released {total} expired reservations.')
+
+def init_app(app):
+    app.cli.add_command(expire_reservations_command)
@@ -0,0 +1,45 @@
+import csv
+import io
+from flask import Response, stream_with_context
+from app.serializers import dumps
+
+CHUNK_SIZE = 64 * 1024
+
+def ndjson_lines(rows):
+    buffer = []
+    size = 0
+    for row in rows:
+        line = dumps(row) + '\n'
+        buffer.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield ''.join(buffer)
+            buffer, size = [], 0
+    if buffer: yield ''.join(buffer)
+
+def csv_lines(rows):
+    buffer = io.StringIO()
+    writer = None
+    for row in rows:
+        if writer is None:
+            writer = csv.DictWriter(buffer, fieldnames=list(row.keys()))
+            writer.writeheader()
+        writer.writerow(row)
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell(): yield buffer.getvalue()
+
+FORMATS = {
+    'ndjson': (ndjson_lines, 'application/x-ndjson'),
+    'csv': (csv_lines, 'text/csv'),
+}
+
+def stream_rows(rows, fmt: str, name: str) -> Response:
+    serialize, mimetype = FORMATS[fmt]
+    response = Response(
+        stream_with_context(serialize(rows)), mimetype=f'{mimetype}; charset=utf-8'
+    )
+    response.headers['Content-Disposition'] = f'attachment; filename={name}.{fmt}'
+    return response
@@ -0,0 +1,158 @@
+"""Load a synthetic shop of any size with COPY.
+
+Run against a freshly initialized database (flask init-db) with an admin
+connection string:
+
+    python -m benchmarks.generate --dsn "..." --products 1000000 --users 1000000
+
+Generated users log in with the password given by --password.
+"""
+import argparse
+import datetime
+import random
+import time
+import psycopg2
+
+from benchmarks.search import NAMES, ADJECTIVES, BRANDS
+
+CITIES = ['Київ', 'Львів', 'Рівне', 'Луцьк', 'Черкаси', 'Херсон', 'Чернігів', 'Одеса']
+FIRST_NAMES = ['Петро', 'Василь', 'Іван', 'Дмитро', 'Денис', 'Олена', 'Юлія', 'Дарія', 'Анастасія']
+LAST_NAMES = ['Петров', 'Кравчина', 'Гайдамака', 'Поліщук', 'Шевченко', 'Франко', 'Кушнір']
+
+# minimal file object feeding generated lines to copy_expert
+class IteratorFile:
+    def __init__(self, lines):
+        self.lines = lines
+        self.buffer = ''
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.lines)
+            except StopIteration:
+                break
+        if size < 0: size = len(self.buffer)
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+def csv_field(value) -> str:
+    if value is None: return ''
+    value = str(value)
+    if any(char in value for char in ',"\n'):
+        value = '"' + value.replace('"', '""') + '"'
+    return value
+
+def copy_rows(cursor, table: str, columns: tuple, rows) -> int:
+    lines = (','.join(map(csv_field, row)) + '\n' for row in rows)
+    started = time.perf_counter()
+    cursor.copy_expert(
+        f'COPY {table} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)',
+        IteratorFile(lines)
+    )
+    elapsed = time.perf_counter() - started
+    print(f'{table:<15} {cursor.rowcount:>10} rows in {elapsed:7.1f}s '
+          f'({cursor.rowcount / elapsed if elapsed else 0:,.0f} rows/sec)')
+    return cursor.rowcount
+
+def new_ids(cursor, table: str, key: str, since: int) -> list:
+    cursor.execute(f'SELECT {key} FROM {table} WHERE {key} > %s ORDER BY {key}', (since, ))
+    return [row[0] for row in cursor.fetchall()]
+
+def max_id(cursor, table: str, key: str) -> int:
+    cursor.execute(f'SELECT coalesce(max({key}), 0) FROM {table}')
+    return cursor.fetchone()[0]
+
+def generate(connection, args) -> None:
+    rnd = random.Random(args.seed)
+    cursor = connection.cursor()
+    tag = args.tag
+
+    since = max_id(cursor, 'categories', 'category_id')
+    copy_rows(cursor, 'categories', ('category_name', ), (
+        (f'{rnd.choice(NAMES)} {tag}-{i}', ) for i in range(args.categories)
+    ))
+    categories = new_ids(cursor, 'categories', 'category_id', since)
+
+    since = max_id(cursor, 'suppliers', 'supplier_id')
+    copy_rows(cursor, 'suppliers', (
+        'company_name', 'contact_name', 'phone', 'email', 'address', 'website_url'
+    ), (
+        (
+            f'{rnd.choice(BRANDS)} {tag}-{i}', f'{rnd.choice(LAST_NAMES)} {rnd.choice(FIRST_NAMES)}',
+            f'+380{rnd.randrange(10 ** 9):09d}', f'{tag}-supplier{i}@example.com',
+            f'м. {rnd.choice(CITIES)}, вул. Київська, {rnd.randrange(1, 200)}', f'{tag}-{i}.com.ua'
+        ) for i in range(args.suppliers)
+    ))
+    suppliers = new_ids(cursor, 'suppliers', 'supplier_id', since)
+
+    since = max_id(cursor, 'products', 'product_id')
+    copy_rows(cursor, 'products', (
+        'category_id', 'supplier_id', 'product_name', 'sku', 'description',
+        'unit_price', 'discount', 'units_in_stock', 'rating'
+    ), (
+        (
+            rnd.choice(categories), rnd.choice(suppliers),
+            f'{rnd.choice(NAMES)} {rnd.choice(ADJECTIVES)} {rnd.choice(BRANDS)} {rnd.randrange(1000)} мм',
+            f'{tag.upper()}{i:09d}',
+            f'{rnd.choice(ADJECTIVES)} {rnd.choice(NAMES).lower()} для внутрішніх і зовнішніх робіт',
+            f'{rnd.uniform(1, 1000):.2f}', rnd.choice((0, 0, 0, 0.05, 0.1)),
+            rnd.randrange(0, 5000), f'{rnd.uniform(3, 5):.1f}'
+        ) for i in range(args.products)
+    ))
+    products = new_ids(cursor, 'products', 'product_id', since)
+
+    since = max_id(cursor, 'customers', 'customer_id')
+    copy_rows(cursor, 'customers', ('first_name', 'last_name', 'phone', 'is_building_contractor'), (
+        (
+            rnd.choice(FIRST_NAMES), rnd.choice(LAST_NAMES),
+            f'+380{rnd.randrange(10 ** 9):09d}', rnd.random() < 0.1
+        ) for _ in range(args.users)
+    ))
+    customers = new_ids(cursor, 'customers', 'customer_id', since)
+
+    copy_rows(cursor, 'users', ('customer_id', 'email', 'password', 'birth_date'), (
+        (
+            customer_id, f'{tag}-user{i}@example.com', args.password,
+            datetime.date(1950, 1, 1) + datetime.timedelta(days=rnd.randrange(20000))
+        ) for i, customer_id in enumerate(customers)
+    ))
+
+    since = max_id(cursor, 'orders', 'order_id')
+    start = datetime.datetime(2019, 1, 1)
+    copy_rows(cursor, 'orders', ('customer_id', 'created_at'), (
+        (rnd.choice(customers), start + datetime.timedelta(seconds=rnd.randrange(3 * 365 * 86400)))
+        for _ in range(args.orders)
+    ))
+    orders = new_ids(cursor, 'orders', 'order_id', since)
+
+    copy_rows(cursor, 'order_details', ('order_id', 'product_id', 'quantity'), (
+        (order_id, product_id, rnd.randrange(1, 20))
+        for order_id in orders
+        for product_id in rnd.sample(products, min(len(products), rnd.randint(1, args.max_lines)))
+    ))
+
+    started = time.perf_counter()
+    cursor.execute('ANALYZE')
+    print(f'analyzed in {time.perf_counter() - started:.1f}s')
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dsn', required=True)
+    parser.add_argument('--categories', type=int, default=100)
+    parser.add_argument('--suppliers', type=int, default=1000)
+    parser.add_argument('--products', type=int, default=100_000)
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--orders', type=int, default=200_000)
+    parser.add_argument('--max-lines', type=int, default=5, help='Upper bound of lines per order.')
+    parser.add_argument('--password', default='benchmark')
+    parser.add_argument('--tag', default='bn', help='Marks generated names, emails and SKUs.')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(args.dsn)
+    with connection:
+        generate(connection, args)
+    connection.close()
+
+if __name__ == '__main__':
+    main()
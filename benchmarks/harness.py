@@ -0,0 +1,214 @@
+"""Time the admin pages and forms through the Flask test client.
+
+Uses the database configured for APP_CONFIG (load it first with
+benchmarks.generate) and writes the results as JSON:
+
+    python -m benchmarks.harness --requests 200 --output results.json
+    python -m benchmarks.harness --compare results.json
+
+Latencies are measured in process, so they include routing, templates and
+queries but not the WSGI server or the network.
+"""
+import argparse
+import io
+import json
+import os
+import statistics
+import subprocess
+import time
+import uuid
+from datetime import datetime, timezone
+
+from app import create_app
+from app.models import Category, PgAPI, Product, Supplier
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def product_form(sku: str, category_id: int, supplier_id: int, **fields) -> dict:
+    data = {
+        'product_name': f'Benchmark {sku}',
+        'category_id': category_id,
+        'supplier_id': supplier_id,
+        'sku': sku,
+        'unit_price': '100.00',
+        'discount': '0.05',
+        'units_in_stock': '10',
+        'description': 'benchmark product',
+        'images': (io.BytesIO(b''), ''),
+        'save': 'Save',
+    }
+    data.update(fields)
+    return data
+
+class Harness:
+    def __init__(self, app, args):
+        self.app = app
+        self.args = args
+        self.admin = app.test_client()
+        with self.admin.session_transaction() as session:
+            session['user_email'] = args.admin
+        self.anonymous = app.test_client()
+
+        with app.app_context():
+            self.product_pk = PgAPI.execute_query('SELECT max(product_id) FROM products')[0][0]
+            self.category_id = Category.get_all_choices()[0][0]
+            self.supplier_id = Supplier.get_all_choices()[0][0]
+        self.created = []
+
+    def scenarios(self) -> dict:
+        deep = self.args.deep_page
+        return {
+            'products': lambda: self.admin.get('/admin/products'),
+            'products_deep': lambda: self.admin.get(f'/admin/products?page={deep}'),
+            'products_search': lambda: self.filter('search', self.args.query),
+            'products_name': lambda: self.filter('name', self.args.query),
+            'products_category': lambda: self.filter('category', self.args.category),
+            'products_name_deep': lambda: self.filter('name', self.args.query, page=deep),
+            'products_price_sorted': lambda: self.admin.get('/admin/products', query_string={
+                'price_min': 100, 'price_max': 500, 'sort': '-price', 'page': deep
+            }),
+            'products_faceted': lambda: self.admin.get('/admin/products', query_string={
+                'category_id': self.category_id, 'price_min': 100, 'price_max': 500,
+                'in_stock': 'y', 'sort': 'price'
+            }),
+            'users': lambda: self.admin.get('/admin/users'),
+            'users_deep': lambda: self.admin.get(f'/admin/users?page={deep}'),
+            'users_search': lambda: self.admin.get('/admin/users', query_string={'q': self.args.user_query}),
+            'product_json': lambda: self.admin.get(f'/admin/products/{self.product_pk}'),
+            'login': self.login,
+            'product_create': self.create,
+            'product_update': self.update,
+        }
+
+    def filter(self, mode: str, query: str, page: int = None):
+        args = {'mode': mode, 'q': query}
+        if page: args['page'] = page
+        return self.admin.get('/admin/products', query_string=args)
+
+    def login(self):
+        response = self.anonymous.post('/auth/login', data={
+            'email': self.args.login_email, 'password': self.args.login_password
+        })
+        with self.anonymous.session_transaction() as session:
+            session.clear()
+        return response
+
+    def create(self):
+        sku = f'HB{uuid.uuid4().hex[:16]}'
+        self.created.append(sku)
+        return self.admin.post('/admin/products/add', content_type='multipart/form-data',
+            data=product_form(sku, self.category_id, self.supplier_id)
+        )
+
+    def update(self):
+        if not self.created: self.create()
+        sku = self.created[-1]
+        with self.app.app_context():
+            pk = Product.get_by_sku(sku).product_id
+            version = Product.get_product(pk).version
+        return self.admin.post(f'/admin/products/update/{pk}', content_type='multipart/form-data',
+            data=product_form(sku, self.category_id, self.supplier_id,
+                unit_price=f'{100 + len(self.created)}.00', version=version)
+        )
+
+    def cleanup(self) -> None:
+        if not self.created: return
+        with self.app.app_context():
+            for sku in self.created:
+                product = Product.get_by_sku(sku)
+                if product: Product.delete(product.product_id)
+
+    def measure(self, name: str, request) -> dict:
+        for _ in range(self.args.warmup):
+            request()
+
+        timings = []
+        started = time.perf_counter()
+        for _ in range(self.args.requests):
+            request_started = time.perf_counter()
+            response = request()
+            timings.append(time.perf_counter() - request_started)
+            if response.status_code >= 400:
+                raise RuntimeError(f'{name}: HTTP {response.status_code}')
+        elapsed = time.perf_counter() - started
+
+        percentiles = statistics.quantiles(timings, n=100) if len(timings) > 1 else timings * 99
+        return {
+            'requests': len(timings),
+            'p50_ms': round(percentiles[49] * 1000, 3),
+            'p95_ms': round(percentiles[94] * 1000, 3),
+            'p99_ms': round(percentiles[98] * 1000, 3),
+            'rps': round(len(timings) / elapsed, 1) if elapsed else None,
+        }
+
+    def run(self) -> dict:
+        scenarios = self.scenarios()
+        names = self.args.only or list(scenarios)
+        results = {}
+        try:
+            for name in names:
+                results[name] = self.measure(name, scenarios[name])
+                print(format_result(name, results[name]))
+        finally:
+            self.cleanup()
+        return results
+
+def format_result(name: str, result: dict, baseline: dict = None) -> str:
+    line = (f"{name:<20} p50 {result['p50_ms']:9.2f} ms  p95 {result['p95_ms']:9.2f} ms  "
+            f"p99 {result['p99_ms']:9.2f} ms  {result['rps']:8.1f} req/s")
+    if baseline:
+        change = (result['p95_ms'] - baseline['p95_ms']) / baseline['p95_ms'] * 100
+        line += f'  p95 {change:+6.1f}% vs {baseline["p95_ms"]:.2f} ms'
+    return line
+
+def compare(results: dict, path: str) -> None:
+    with open(path) as fhand:
+        baseline = json.load(fhand)
+    print(f"\ncompared with {baseline.get('commit')} ({baseline.get('timestamp')}):")
+    for name, result in results.items():
+        print(format_result(name, result, baseline['results'].get(name)))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=100, help='Measured requests per scenario.')
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--deep-page', type=int, default=1000)
+    parser.add_argument('--query', default='Гіпсо')
+    parser.add_argument('--category', default='Гіпсокартон')
+    parser.add_argument('--user-query', default='user12')
+    parser.add_argument('--admin', default='admin@admin.admin')
+    parser.add_argument('--login-email', default='bn-user0@example.com')
+    parser.add_argument('--login-password', default='benchmark')
+    parser.add_argument('--only', nargs='+', metavar='SCENARIO')
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    parser.add_argument('--compare', metavar='JSON', help='Compare with earlier results.')
+    args = parser.parse_args()
+
+    app = create_app(os.environ.get('APP_CONFIG') or 'default')
+    app.config['WTF_CSRF_ENABLED'] = False
+    harness = Harness(app, args)
+    unknown = set(args.only or ()) - set(harness.scenarios())
+    if unknown: parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+
+    results = harness.run()
+    if args.compare: compare(results, args.compare)
+    if args.output:
+        report = {
+            'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'parameters': {
+                key: value for key, value in vars(args).items() if key not in ('output', 'compare')
+            },
+            'results': results,
+        }
+        with open(args.output, 'w') as fhand:
+            json.dump(report, fhand, indent=2, ensure_ascii=False)
+
+if __name__ == '__main__':
+    main()
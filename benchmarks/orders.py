@@ -0,0 +1,87 @@
+"""Compare per-line order inserts with the create_order procedure.
+
+Inserting order lines fires tg_set_order_discount once per line, which
+re-sums and rewrites the whole order; create_order writes all lines at once.
+Both paths run on the same random lines and their discounts are checked to
+be equal. Everything is rolled back at the end:
+
+    python -m benchmarks.orders --dsn "..." --lines 10 100 1000
+"""
+import argparse
+import random
+import statistics
+import time
+import psycopg2
+from psycopg2.extras import execute_values
+
+def random_lines(cursor, rnd: random.Random, count: int) -> list:
+    cursor.execute('SELECT product_id FROM products ORDER BY random() LIMIT %s', (count, ))
+    return [(row[0], rnd.randint(1, 50)) for row in cursor.fetchall()]
+
+def insert_per_line(cursor, customer_id: int, lines: list) -> int:
+    cursor.execute(
+        'INSERT INTO orders (customer_id, created_at) VALUES (%s, now()) RETURNING order_id',
+        (customer_id, )
+    )
+    order_id = cursor.fetchone()[0]
+    execute_values(cursor,
+        'INSERT INTO order_details (order_id, product_id, quantity) VALUES %s',
+        [(order_id, product_id, quantity) for product_id, quantity in lines],
+        page_size=len(lines)
+    )
+    return order_id
+
+def insert_bulk(cursor, customer_id: int, lines: list) -> int:
+    cursor.execute('CALL create_order(%s, %s::int[], %s::int[])', (
+        customer_id, [line[0] for line in lines], [line[1] for line in lines]
+    ))
+    return cursor.fetchone()[0]
+
+def discounts(cursor, order_id: int) -> list:
+    cursor.execute(
+        'SELECT DISTINCT discount FROM order_details WHERE order_id = %s', (order_id, )
+    )
+    return sorted(row[0] for row in cursor.fetchall())
+
+def run(connection, sizes: list, repeat: int, seed: int) -> None:
+    rnd = random.Random(seed)
+    cursor = connection.cursor()
+    cursor.execute('SELECT setseed(%s)', (rnd.random(), ))
+    cursor.execute('SELECT min(customer_id) FROM customers')
+    customer_id = cursor.fetchone()[0]
+    paths = [('per line', insert_per_line), ('create_order', insert_bulk)]
+
+    print(f'{"lines":>6} {"path":<14} {"p50 ms":>10} {"max ms":>10} {"discount":>9}')
+    for size in sizes:
+        lines = random_lines(cursor, rnd, size)
+        results = {}
+        for name, insert in paths:
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                order_id = insert(cursor, customer_id, lines)
+                timings.append((time.perf_counter() - started) * 1000)
+            results[name] = discounts(cursor, order_id)
+            print(f'{len(lines):>6} {name:<14} {statistics.median(timings):>10.2f} '
+                  f'{max(timings):>10.2f} {", ".join(map(str, results[name])):>9}')
+        if results['per line'] != results['create_order']:
+            print(f'MISMATCH for {len(lines)} lines: {results}')
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dsn', required=True)
+    parser.add_argument('--lines', type=int, nargs='+', default=[10, 100, 1000],
+                        help='Order sizes to compare.')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(args.dsn)
+    try:
+        run(connection, args.lines, args.repeat, args.seed)
+    finally:
+        connection.rollback()
+        connection.close()
+
+if __name__ == '__main__':
+    main()
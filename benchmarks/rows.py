@@ -0,0 +1,95 @@
+"""Compare DictCursor, RealDictCursor and app.rows records on large list pages.
+
+Every variant fetches the same page of the product list, then renders it
+with a Jinja template that reads each field by attribute, as the admin
+table does. Reported are the time to fetch and build the rows, the time to
+render them and the memory the rows hold:
+
+    python -m benchmarks.rows --dsn "..." --rows 100 1000 10000
+"""
+import argparse
+import statistics
+import time
+import tracemalloc
+import psycopg2
+from jinja2 import Template
+from psycopg2.extras import DictCursor, RealDictCursor
+
+from app.rows import columns, ProductListRow
+
+TEMPLATE = Template("""
+{%- for product in products -%}
+<tr><td>{{ product.product_id }}</td><td>{{ product.product_name }}</td><td>{{ product.sku }}</td>
+<td>{{ product.description }}</td><td>{{ product.category_name }}</td><td>{{ product.supplier_name }}</td>
+<td>{{ '%.2f' % product.unit_price }}</td><td>{{ product.discount }}</td><td>{{ product.units_in_stock }}</td></tr>
+{% endfor -%}
+""")
+
+def fetch_dict(connection, query: str, limit: int) -> list:
+    cursor = connection.cursor(cursor_factory=DictCursor)
+    cursor.execute(query.replace('{columns}', '*'), (limit, ))
+    return cursor.fetchall()
+
+def fetch_rdict(connection, query: str, limit: int) -> list:
+    cursor = connection.cursor(cursor_factory=RealDictCursor)
+    cursor.execute(query.replace('{columns}', '*'), (limit, ))
+    return cursor.fetchall()
+
+def fetch_rows(connection, query: str, limit: int) -> list:
+    cursor = connection.cursor()
+    cursor.execute(query.replace('{columns}', columns(ProductListRow)), (limit, ))
+    return list(map(ProductListRow._make, cursor.fetchall()))
+
+def measure(connection, fetch, query: str, limit: int, repeat: int) -> dict:
+    fetch_ms, render_ms = [], []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        products = fetch(connection, query, limit)
+        fetch_ms.append((time.perf_counter() - started) * 1000)
+        started = time.perf_counter()
+        TEMPLATE.render(products=products)
+        render_ms.append((time.perf_counter() - started) * 1000)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    products = fetch(connection, query, limit)
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return {
+        'rows': len(products),
+        'fetch_ms': statistics.median(fetch_ms),
+        'render_ms': statistics.median(render_ms),
+        'kib': held / 1024,
+    }
+
+def run(connection, sizes: list, repeat: int, source: str) -> None:
+    query = f'SELECT {{columns}} FROM {source} ORDER BY product_id LIMIT %s'
+    variants = [('DictCursor', fetch_dict), ('RealDictCursor', fetch_rdict), ('rows', fetch_rows)]
+    print(f'{"rows":>7} {"variant":<15} {"fetch ms":>10} {"render ms":>10} {"KiB held":>10} '
+          f'{"B/row":>7}')
+    for size in sizes:
+        for name, fetch in variants:
+            result = measure(connection, fetch, query, size, repeat)
+            print(f'{result["rows"]:>7} {name:<15} {result["fetch_ms"]:>10.2f} '
+                  f'{result["render_ms"]:>10.2f} {result["kib"]:>10.1f} '
+                  f'{result["kib"] * 1024 / max(result["rows"], 1):>7.0f}')
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dsn', required=True)
+    parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='Page sizes to compare.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--source', default='v_products_all',
+                        help='View or table with the ProductListRow columns.')
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(args.dsn)
+    connection.autocommit = True
+    try:
+        run(connection, args.rows, args.repeat, args.source)
+    finally:
+        connection.close()
+
+if __name__ == '__main__':
+    main()
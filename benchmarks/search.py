@@ -0,0 +1,105 @@
+"""Compare prefix ILIKE filtering with ranked search_products.
+
+Loads synthetic products into the database given by --dsn (an admin
+connection string, e.g. "host=localhost dbname=postgres user=postgres"),
+then times both search paths for a few typical queries:
+
+    python -m benchmarks.search --dsn "..." --products 1000000
+"""
+import argparse
+import statistics
+import time
+import psycopg2
+
+SKU_PREFIX = 'BN-'
+
+NAMES = [
+    'Гіпсокартон', 'Профіль', 'Шпатлівка', 'Клей', 'Цегла', 'Плитка',
+    'Лінолеум', 'Черепиця', 'Металочерепиця', 'Утеплювач', 'Фарба', 'Сітка',
+]
+ADJECTIVES = [
+    'вологостійкий', 'вогнестійкий', 'фінішна', 'вібропресована', 'червона',
+    'матова', 'графітова', 'тротуарна', 'бітумна', 'акрилова', 'фасадна',
+]
+BRANDS = ['Knauf', 'Kerezit', 'Polimin', 'ЯПВ', 'IDEAL', 'PSM', 'Бардолін', 'ISOOM']
+
+QUERIES = ['Гіпсо', 'вологостійкий', 'Knauf', 'червона цегла', 'BN-00012', 'Лінолеум']
+
+def load_products(connection, count: int) -> None:
+    cursor = connection.cursor()
+    cursor.execute('SELECT count(*) FROM products WHERE sku LIKE %s', (SKU_PREFIX + '%', ))
+    existing = cursor.fetchone()[0]
+    if existing >= count: return
+
+    started = time.perf_counter()
+    cursor.execute("""
+        INSERT INTO products (
+            category_id, supplier_id, product_name, sku,
+            description, unit_price, discount, units_in_stock
+        )
+        SELECT (SELECT array_agg(category_id) FROM categories)[1 + i %% (SELECT count(*) FROM categories)::int],
+               (SELECT array_agg(supplier_id) FROM suppliers)[1 + i %% (SELECT count(*) FROM suppliers)::int],
+               concat_ws(' ', %(names)s[1 + i %% %(n)s], %(adjectives)s[1 + (i / 7) %% %(a)s],
+                         %(brands)s[1 + (i / 13) %% %(b)s], i %% 1000, 'мм'),
+               %(prefix)s || lpad(i::text, 9, '0'),
+               concat_ws(' ', %(adjectives)s[1 + (i / 3) %% %(a)s], %(names)s[1 + (i / 5) %% %(n)s],
+                         'для внутрішніх і зовнішніх робіт'),
+               round((random() * 1000)::numeric, 2), 0, (random() * 500)::int
+        FROM generate_series(%(start)s, %(stop)s) AS i
+    """, {
+        'names': NAMES, 'n': len(NAMES),
+        'adjectives': ADJECTIVES, 'a': len(ADJECTIVES),
+        'brands': BRANDS, 'b': len(BRANDS),
+        'prefix': SKU_PREFIX, 'start': existing, 'stop': count - 1,
+    })
+    cursor.execute('ANALYZE products')
+    elapsed = time.perf_counter() - started
+    print(f'loaded {count - existing} products in {elapsed:.1f}s')
+
+def cleanup(connection) -> None:
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM products WHERE sku LIKE %s', (SKU_PREFIX + '%', ))
+    print(f'removed {cursor.rowcount} products')
+
+def measure(connection, query: str, args: tuple, repeat: int) -> tuple:
+    cursor = connection.cursor()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        cursor.execute(query, args)
+        rows = cursor.fetchall()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings, len(rows)
+
+def run(connection, repeat: int, limit: int) -> None:
+    paths = [
+        ('ilike prefix', "SELECT * FROM v_products_all WHERE product_name ILIKE "
+                         "concat(%s, '%%') LIMIT %s"),
+        ('search_products', 'SELECT * FROM search_products(%s, %s)'),
+    ]
+    print(f'{"query":<16} {"path":<16} {"rows":>6} {"p50 ms":>9} {"max ms":>9}')
+    for term in QUERIES:
+        for name, query in paths:
+            timings, rows = measure(connection, query, (term, limit), repeat)
+            print(f'{term:<16} {name:<16} {rows:>6} '
+                  f'{statistics.median(timings):>9.2f} {max(timings):>9.2f}')
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dsn', required=True)
+    parser.add_argument('--products', type=int, default=1_000_000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--limit', type=int, default=100)
+    parser.add_argument('--cleanup', action='store_true')
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(args.dsn)
+    connection.autocommit = True
+    if args.cleanup:
+        cleanup(connection)
+        return
+    load_products(connection, args.products)
+    run(connection, args.repeat, args.limit)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""Stress stock changes of a hot product from many concurrent checkouts.
+
+Every thread places orders of random lines in random line order; each order
+contains the hot SKU and takes stock in one of three ways:
+
+    unlocked  reads the stock and writes it back, one line at a time
+    locked    the same, but locks each line with SELECT ... FOR UPDATE
+    reserve   the reserve_stock procedure
+
+After each run the units sold are checked against the stock that actually
+left the products. The stock of the products used is restored and the
+reservations made are deleted at the end:
+
+    python -m benchmarks.stock --dsn "..." --threads 16 --seconds 5
+"""
+import argparse
+import random
+import statistics
+import threading
+import time
+from datetime import timedelta
+import psycopg2
+from psycopg2 import errors
+
+MAX_RETRIES = 5
+
+def read_modify_write(cursor, lines: list, lock: bool) -> bool:
+    for product_id, quantity in lines:
+        cursor.execute(
+            'SELECT units_in_stock FROM products WHERE product_id = %s' +
+            (' FOR UPDATE' if lock else ''), (product_id, )
+        )
+        stock = cursor.fetchone()[0]
+        if stock < quantity: return False
+        cursor.execute(
+            'UPDATE products SET units_in_stock = %s WHERE product_id = %s',
+            (stock - quantity, product_id)
+        )
+    return True
+
+def take_lines(connection, lines: list, lock: bool) -> bool:
+    with connection:
+        if read_modify_write(connection.cursor(), lines, lock): return True
+        connection.rollback()
+        return False
+
+def take_unlocked(connection, customer_id: int, lines: list) -> bool:
+    return take_lines(connection, lines, lock=False)
+
+def take_locked(connection, customer_id: int, lines: list) -> bool:
+    return take_lines(connection, lines, lock=True)
+
+def take_reserve(connection, customer_id: int, lines: list) -> int:
+    try:
+        with connection:
+            cursor = connection.cursor()
+            cursor.execute('CALL reserve_stock(%s, %s::int[], %s::int[], %s)', (
+                customer_id, [line[0] for line in lines], [line[1] for line in lines],
+                timedelta(hours=1)
+            ))
+            return cursor.fetchone()[0]
+    except errors.CheckViolation:
+        return None
+
+class Worker(threading.Thread):
+    def __init__(self, dsn: str, take, customer_id: int, hot: int, products: list,
+                 args, seed: int, deadline: float):
+        super().__init__()
+        self.connection = psycopg2.connect(dsn)
+        self.take = take
+        self.customer_id = customer_id
+        self.hot = hot
+        self.products = products
+        self.args = args
+        self.rnd = random.Random(seed)
+        self.deadline = deadline
+        self.timings = []
+        self.placed = 0
+        self.sold = 0
+        self.rejected = 0
+        self.deadlocks = 0
+        self.failed = 0
+        self.reservations = []
+
+    def order_lines(self) -> list:
+        others = self.rnd.sample(self.products, self.rnd.randint(0, self.args.max_lines - 1))
+        lines = [(product_id, self.rnd.randint(1, 3)) for product_id in [self.hot] + others]
+        self.rnd.shuffle(lines)
+        return lines
+
+    def run(self) -> None:
+        try:
+            while time.perf_counter() < self.deadline:
+                self.checkout(self.order_lines())
+        finally:
+            self.connection.close()
+
+    def checkout(self, lines: list) -> None:
+        started = time.perf_counter()
+        for _ in range(MAX_RETRIES):
+            try:
+                result = self.take(self.connection, self.customer_id, lines)
+                break
+            except errors.DeadlockDetected:
+                self.deadlocks += 1
+        else:
+            self.failed += 1
+            return
+        self.timings.append((time.perf_counter() - started) * 1000)
+        if not result:
+            self.rejected += 1
+            return
+        self.placed += 1
+        self.sold += sum(quantity for _, quantity in lines)
+        if result is not True: self.reservations.append(result)
+
+def stock_total(cursor, pks: list) -> tuple:
+    cursor.execute(
+        'SELECT sum(units_in_stock), count(*) FILTER (WHERE units_in_stock < 0) '
+        'FROM products WHERE product_id = ANY(%s)', (pks, )
+    )
+    return cursor.fetchone()
+
+def reserved_total(cursor, reservations: list) -> int:
+    cursor.execute(
+        'SELECT coalesce(sum(quantity), 0) FROM reservation_lines '
+        'WHERE reservation_id = ANY(%s)', (reservations, )
+    )
+    return cursor.fetchone()[0]
+
+def run_mode(dsn: str, cursor, name: str, take, pks: list, customer_id: int, args) -> list:
+    cursor.execute('UPDATE products SET units_in_stock = %s WHERE product_id = ANY(%s)',
+        (args.stock, pks))
+    deadline = time.perf_counter() + args.seconds
+    workers = [
+        Worker(dsn, take, customer_id, pks[0], pks[1:], args, args.seed + i, deadline)
+        for i in range(args.threads)
+    ]
+    started = time.perf_counter()
+    for worker in workers: worker.start()
+    for worker in workers: worker.join()
+    elapsed = time.perf_counter() - started
+
+    timings = [timing for worker in workers for timing in worker.timings]
+    placed = sum(worker.placed for worker in workers)
+    sold = sum(worker.sold for worker in workers)
+    reservations = [pk for worker in workers for pk in worker.reservations]
+    remaining, negative = stock_total(cursor, pks)
+    taken = args.stock * len(pks) - remaining
+    print(f'{name:<9} {len(timings) / elapsed:>9.1f} {placed / elapsed:>9.1f} '
+          f'{statistics.median(timings) if timings else 0:>8.2f} '
+          f'{max(timings, default=0):>8.2f} {sum(w.deadlocks for w in workers):>9} '
+          f'{sum(w.failed for w in workers):>6} {sold:>7} {taken:>7} '
+          f'{sold - taken:>9} {negative:>8}')
+    if reservations and reserved_total(cursor, reservations) != taken:
+        print(f'MISMATCH: {name} reserved {reserved_total(cursor, reservations)} '
+              f'but took {taken} units')
+    return reservations
+
+def run(dsn: str, args) -> None:
+    connection = psycopg2.connect(dsn)
+    connection.autocommit = True
+    cursor = connection.cursor()
+    cursor.execute('SELECT product_id FROM products WHERE sku = %s', (args.sku, ))
+    hot = cursor.fetchone()
+    if hot is None: raise SystemExit(f'no product with sku {args.sku}')
+    cursor.execute(
+        'SELECT product_id FROM products WHERE product_id <> %s ORDER BY random() LIMIT %s',
+        (hot[0], args.products)
+    )
+    pks = [hot[0]] + [row[0] for row in cursor.fetchall()]
+    cursor.execute('SELECT min(customer_id) FROM customers')
+    customer_id = cursor.fetchone()[0]
+    cursor.execute('SELECT product_id, units_in_stock FROM products WHERE product_id = ANY(%s)',
+        (pks, ))
+    saved = cursor.fetchall()
+
+    modes = {'unlocked': take_unlocked, 'locked': take_locked, 'reserve': take_reserve}
+    reservations = []
+    print(f'{args.threads} threads, {args.seconds}s per mode, {len(pks)} products '
+          f'with {args.stock} units each, up to {args.max_lines} lines per order')
+    print(f'{"mode":<9} {"orders/s":>9} {"placed/s":>9} {"p50 ms":>8} {"max ms":>8} '
+          f'{"deadlocks":>9} {"failed":>6} {"sold":>7} {"taken":>7} {"oversold":>9} '
+          f'{"negative":>8}')
+    try:
+        for name in args.modes:
+            reservations += run_mode(dsn, cursor, name, modes[name], pks, customer_id, args)
+    finally:
+        cursor.execute('DELETE FROM reservations WHERE reservation_id = ANY(%s)',
+            (reservations, ))
+        cursor.execute("""
+            UPDATE products p SET units_in_stock = s.units_in_stock
+            FROM unnest(%s::int[], %s::int[]) AS s (product_id, units_in_stock)
+            WHERE p.product_id = s.product_id
+        """, ([row[0] for row in saved], [row[1] for row in saved]))
+        connection.close()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dsn', required=True)
+    parser.add_argument('--sku', default='RHG80L-MN', help='The hot product every order contains.')
+    parser.add_argument('--products', type=int, default=20,
+                        help='Other products orders draw lines from.')
+    parser.add_argument('--stock', type=int, default=2000, help='Units of every product.')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--max-lines', type=int, default=5)
+    parser.add_argument('--modes', nargs='+', choices=('unlocked', 'locked', 'reserve'),
+                        default=['unlocked', 'locked', 'reserve'])
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    run(args.dsn, args)
+
+if __name__ == '__main__':
+    main()
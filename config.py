@@ -2,9 +2,54 @@ import os
 
 POSTGRES_HOST = os.environ.get('POSTGRES_HOST')
 POSTGRES_DB= os.environ.get('POSTGRES_DB')
+# comma separated host[:port] of streaming replicas, e.g. "localhost:5433"
+POSTGRES_READ_HOSTS = os.environ.get('POSTGRES_READ_HOSTS', '')
+
+# an empty value turns the setting off
+def optional_float(name: str, default: float = None) -> float:
+    value = os.environ.get(name)
+    if value is None: return default
+    return float(value) if value.strip() else None
+
+def replicas_of(database: dict) -> list:
+    replicas = []
+    for address in filter(None, POSTGRES_READ_HOSTS.split(',')):
+        host, _, port = address.strip().partition(':')
+        replicas.append(dict(database, host=host, port=port or None))
+    return replicas
 
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'secret'
+    PRODUCTS_PER_PAGE = int(os.environ.get('PRODUCTS_PER_PAGE', 3))
+    PRODUCTS_COUNT_TTL = int(os.environ.get('PRODUCTS_COUNT_TTL', 30))
+    SEARCH_LIMIT = int(os.environ.get('SEARCH_LIMIT', 100))
+    PRODUCT_CACHE_TTL = int(os.environ.get('PRODUCT_CACHE_TTL', 300))
+    DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', 1))
+    DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 10))
+    DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 5))
+    DB_POOL_CHECK = os.environ.get('DB_POOL_CHECK', '1') == '1'
+    DB_LISTEN = os.environ.get('DB_LISTEN', '0') == '1'
+    DB_STREAM_ITERSIZE = int(os.environ.get('DB_STREAM_ITERSIZE', 2000))
+    SLOW_QUERY_MS = optional_float('SLOW_QUERY_MS', 200)
+    SERVER_TIMING = os.environ.get('SERVER_TIMING', '0') == '1'
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 1024))
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 60))
+    USERS_COUNT_TTL = int(os.environ.get('USERS_COUNT_TTL', 30))
+    REFDATA_CHECK_INTERVAL = float(os.environ.get('REFDATA_CHECK_INTERVAL', 5))
+    IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+    IMAGE_QUEUE_SIZE = int(os.environ.get('IMAGE_QUEUE_SIZE', 16))
+    IMAGE_QUEUE_TIMEOUT = float(os.environ.get('IMAGE_QUEUE_TIMEOUT', 2))
+    IMAGE_SPOOL_PATH = os.environ.get('IMAGE_SPOOL_PATH')
+    IMAGE_WEB_SIZE = int(os.environ.get('IMAGE_WEB_SIZE', 1200))
+    IMAGE_THUMB_SIZE = int(os.environ.get('IMAGE_THUMB_SIZE', 200))
+    IMAGE_WEB_QUALITY = int(os.environ.get('IMAGE_WEB_QUALITY', 85))
+    FRAGMENT_CACHE = os.environ.get('FRAGMENT_CACHE', 'memory')
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE', 32 * 1024 * 1024))
+    FRAGMENT_CACHE_PATH = os.environ.get('FRAGMENT_CACHE_PATH')
+    FRAGMENT_CACHE_FILES = int(os.environ.get('FRAGMENT_CACHE_FILES', 10000))
+    READ_DATABASES = []
+    READ_AFTER_WRITE = float(os.environ.get('READ_AFTER_WRITE', 5))
+    RESERVATION_TTL = float(os.environ.get('RESERVATION_TTL', 900))
 
 class DevelopmentConfig(Config):
     DEBUG = True
@@ -14,6 +59,7 @@ class DevelopmentConfig(Config):
         'user': os.environ.get('PYSHOP_USER'),
         'password': os.environ.get('PYSHOP_PASSWORD'),
     }
+    READ_DATABASES = replicas_of(DATABASE)
     ADMIN_DATABASE = {
         'host': POSTGRES_HOST,
         'dbname': POSTGRES_DB,